@@ -4,17 +4,18 @@
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
 # Python imports
-import logging
+import logging, hashlib
 
 # Imports from appengineapi-kit
-from appengineapi_kit import api,model,gaedatastore
+from appengineapi_kit import api,models,gaedatastore,cache
 
-class AddressBookEntry(model.Model):
+class AddressBookEntry(models.Model):
 	# STORAGE
 	proxy = gaedatastore.DataStore("addressbook_entry")
+	entity_cache = cache.EntityCache(local=cache.LRUCache(max_size=1000,ttl=5),shared=cache.MemcacheTier())
 	# PROPERTIES
-	name = model.StringProperty(notnull=True,minlength=0,maxlength=100)
-	email = model.StringProperty(notnull=False,minlength=0,maxlength=100)
+	name = models.StringProperty(notnull=True,minlength=0,maxlength=100)
+	email = models.StringProperty(notnull=False,minlength=0,maxlength=100)
 
 class RequestHandler(api.RequestHandler):
 	"""Implementation of the Address Book API"""
@@ -29,22 +30,59 @@ class RequestHandler(api.RequestHandler):
 			return limit
 		except ValueError, e:
 			raise api.HTTPException(api.HTTPException.STATUS_BADREQUEST,"Invalid 'limit' parameter")
+	def _get_etag(self,name,key,version):
+		return "%s-%s-%d" % (name,key,version * 1000000)
+	def _get_feed_etag(self,version):
+		return "%s-%d" % (hashlib.md5(self.request.path_qs).hexdigest(),version * 1000000)
 	def get_object(self,name,key):
 		"""Get AddressBookEntry object"""
 		if name != "addressbook_entry":
 			raise api.HTTPException(api.HTTPException.STATUS_BADREQUEST,"Bad request, expecting addressbook_entry")
+		# where the version is known and the client has it, respond without reading the entity
+		version = AddressBookEntry.get_version(long(key))
+		if version != None and self.response_not_modified(self.get_response_etag(self._get_etag(name,key,version)),version):
+			return
 		entry = AddressBookEntry.get_by_key(long(key))
 		if not entry:
 			raise api.HTTPException(api.HTTPException.STATUS_NOTFOUND,"No addressbook_entry entity with key %s" % key)
 		assert isinstance(entry,AddressBookEntry)
-		return self.response_json(entry)
+		version = AddressBookEntry.get_version(long(key))
+		if version==None:
+			return self.response_json(entry)
+		return self.response_json(entry,etag=self._get_etag(name,key,version),last_modified=version)
 	def get_feed(self,name):
 		"""Get AddressBookEntry feed"""
 		if name != "addressbook_entry":
 			raise api.HTTPException(api.HTTPException.STATUS_BADREQUEST,"Bad request, expecting addressbook_entry")
+		# the feed changes when any entry is stored or deleted, so the version of the
+		# kind is the validator. It is read before the query, so the feed is no older
+		version = AddressBookEntry.get_kind_version()
 		query = AddressBookEntry.get_query()
 		limit = self._get_param_limit()
-		return self.response_json(query.execute(limit=limit))
+		cursor = self.request.get('cursor',None) or None
+		try:
+			# filter on property values, sort on 'order' (prefix with - for descending),
+			# return only the comma-separated 'fields' properties, or only keys when
+			# 'keys' is set, and include the number of matching entities when 'total' is set
+			for property_name in AddressBookEntry._get_properties():
+				value = self.request.get(property_name,None)
+				if value:
+					query.filter(property_name,"=",value)
+			order = self.request.get('order',None)
+			if order:
+				query.order(order.lstrip("-"),descending=order.startswith("-"))
+			fields = self.request.get('fields',None)
+			if fields:
+				query.fields(*fields.split(","))
+			if self.request.get('keys',None) in ("1","true"):
+				query.keys_only()
+			total = self.request.get('total',None) in ("1","true")
+			feed = query.execute(limit=limit,stream=True,cursor=cursor,total=total)
+		except ValueError, e:
+			raise api.HTTPException(api.HTTPException.STATUS_BADREQUEST,"Bad request: %s" % e)
+		if version==None:
+			return self.response_json(feed)
+		return self.response_json(feed,etag=self._get_feed_etag(version),last_modified=version)
 	def create_object(self,path,entry):
 		"""Create new AddressBookEntry object"""
 		if not isinstance(entry,AddressBookEntry):
@@ -84,6 +122,11 @@ class RequestHandler(api.RequestHandler):
 		AddressBookEntry,
 	)
 	routes = (
+		(api.RequestHandler.METHOD_GET,r"^/?(\w+)/_batch$",api.RequestHandler.batch_get),
+		(api.RequestHandler.METHOD_POST,r"^/?_batch$",api.RequestHandler.batch_create),
+		(api.RequestHandler.METHOD_POST,r"^/?(\w+)/_delete$",api.RequestHandler.batch_delete),
+		(api.RequestHandler.METHOD_POST,r"^/?(\w+)/_import$",api.RequestHandler.bulk_import),
+		(api.RequestHandler.METHOD_GET,r"^/?(\w+)/_export$",api.RequestHandler.bulk_export),
 		(api.RequestHandler.METHOD_GET,r"^/?(\w+)/([1-9][0-9]*)$",get_object),
 		(api.RequestHandler.METHOD_GET,r"^/?(\w+)$",get_feed),
 		(api.RequestHandler.METHOD_POST,r"^/?([\w\/]*)$",create_object),
@@ -4,7 +4,10 @@
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
 # Python imports
-import sys, os, logging
+import sys, os, time, logging
+
+# time the instance started loading the application, for startup timings
+load_start = time.time()
 
 # add python libraries:
 #  - 'app' is for application code
@@ -22,16 +25,27 @@ for path in code_paths:
 # GAE imports
 import webapp2
 
-# app imports
-from test import apihandler
+# appengineapi-kit imports
+from appengineapi_kit import startup
 
-# route /api/test /api/test/ and /api/test/... messages through to the apihandler
+# route /api/test /api/test/ and /api/test/... messages through to the apihandler.
+# Handlers are named as strings, so that handler modules and the data store
+# backends they use are imported by the warmup request or the first request
+# routed to them, rather than when the instance loads
 app = webapp2.WSGIApplication([
-	('/api/test([\w\/]*)',apihandler.RequestHandler),
+	('/_ah/warmup',startup.WarmupHandler),
+	('/api/test([\w\/]*)','test.apihandler.RequestHandler'),
 ])
 
-# add values to the registry
+# add values to the registry. Set 'instrument' to a dictionary of settings, for
+# example { 'log': True, 'profile_threshold': 0.5 }, to record request timings,
+# and 'throttle' to a dictionary of settings, for example { 'rate': 10,
+# 'burst': 20, 'coalesce': True }, to rate limit clients and coalesce reads
 app.registry = {
-	'debug': True
+	'debug': True,
+	'instrument': None,
+	'throttle': None
 }
 app.debug = app.registry['debug']
+
+startup.loaded(load_start)
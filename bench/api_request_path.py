@@ -0,0 +1,137 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark the API request path end to end
+
+Requests are made in-process through the WSGI interface of application.app,
+with AddressBookEntry stored in the in-memory data store. For GET object,
+GET feed with several limits, POST create, PUT update and DELETE, reports
+the p50 and p99 latency, requests per second and allocations per request,
+and saves the results as JSON. Python 2.7 has no allocation tracer, so
+allocations are measured as the net change in gc-tracked objects, with the
+garbage collector disabled so that objects left in reference cycles count.
+Run with the App Engine SDK on the path:
+
+  python bench/api_request_path.py [count] [output]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, gc, time, json, platform
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+if benchutil.root_path not in sys.path:
+	sys.path.insert(0,benchutil.root_path)
+
+# GAE imports
+import webapp2
+
+# appengineapi-kit imports
+from appengineapi_kit import cache, memorydatastore
+from test import apihandler
+import application
+
+# number of entities stored before the requests are made
+DATASET_SIZE = 1000
+FEED_LIMITS = (10,100,1000)
+
+def setup_store():
+	"""Store AddressBookEntry objects in memory, and return their keys"""
+	model = apihandler.AddressBookEntry
+	model.proxy = memorydatastore.DataStore(model.get_kind(),storage=memorydatastore.Storage())
+	model.entity_cache = cache.EntityCache(local=cache.LRUCache(max_size=DATASET_SIZE))
+	entries = [ model(name="Entry %s" % i,email="entry%s@example.com" % i) for i in xrange(DATASET_SIZE) ]
+	model.put_multi(entries)
+	return [ entry.key() for entry in entries ]
+
+def make_requests(keys,count):
+	"""Return list of (name,requests) for each scenario, where each request is (method,path,body)"""
+	scenarios = [ ]
+	scenarios.append(("get_object",[ ("GET","/api/test/addressbook_entry/%s" % keys[i % len(keys)],None) for i in xrange(count) ]))
+	for limit in FEED_LIMITS:
+		scenarios.append(("get_feed_limit_%d" % limit,[ ("GET","/api/test/addressbook_entry?limit=%d" % limit,None) ] * count))
+	body = lambda i: json.dumps({ '_type': "addressbook_entry", 'name': "New entry %s" % i, 'email': "new%s@example.com" % i })
+	scenarios.append(("post_create",[ ("POST","/api/test",body(i)) for i in xrange(count) ]))
+	body = lambda i: json.dumps({ 'email': "updated%s@example.com" % i })
+	scenarios.append(("put_update",[ ("PUT","/api/test/addressbook_entry/%s" % keys[i % len(keys)],body(i)) for i in xrange(count) ]))
+	return scenarios
+
+def make_delete_requests(count):
+	"""Return requests which delete objects created for the scenario"""
+	model = apihandler.AddressBookEntry
+	entries = [ model(name="Deleted entry %s" % i) for i in xrange(count) ]
+	model.put_multi(entries)
+	return [ ("DELETE","/api/test/addressbook_entry/%s" % entry.key(),None) for entry in entries ]
+
+def percentile(values,fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1,int(len(values) * fraction))]
+
+def run_scenario(requests):
+	"""Return dictionary of results for making a list of requests"""
+	latencies = [ ]
+	errors = 0
+	gc.collect()
+	gc.disable()
+	objects = len(gc.get_objects())
+	try:
+		start = time.time()
+		for (method,path,body) in requests:
+			request = webapp2.Request.blank(path)
+			request.method = method
+			if body != None:
+				request.body = body
+				request.content_type = "application/json"
+			request_start = time.time()
+			response = request.get_response(application.app)
+			latencies.append(time.time() - request_start)
+			if response.status_int >= 400:
+				errors += 1
+		elapsed = time.time() - start
+		objects = len(gc.get_objects()) - objects
+	finally:
+		gc.enable()
+	return {
+		'requests': len(requests),
+		'errors': errors,
+		'p50_ms': percentile(latencies,0.50) * 1000.0,
+		'p99_ms': percentile(latencies,0.99) * 1000.0,
+		'mean_ms': sum(latencies) * 1000.0 / len(latencies),
+		'requests_per_sec': len(requests) / elapsed,
+		'gc_objects_per_request': float(objects) / len(requests)
+	}
+
+def run(count,output):
+	keys = setup_store()
+	scenarios = make_requests(keys,count)
+	scenarios.append(("delete",make_delete_requests(count)))
+	results = { }
+	rows = [ ]
+	for (name,requests) in scenarios:
+		# warm up caches and compiled state before measuring reads
+		if name.startswith("get_"):
+			run_scenario(requests[:10])
+		result = run_scenario(requests)
+		results[name] = result
+		rows.append(("%s: p50 / p99 msec" % name,"%.3f / %.3f" % (result['p50_ms'],result['p99_ms'])))
+		rows.append(("%s: requests per sec" % name,"%.0f" % result['requests_per_sec']))
+		rows.append(("%s: gc objects per request" % name,"%.1f" % result['gc_objects_per_request']))
+		if result['errors']:
+			rows.append(("%s: errors" % name,"%d" % result['errors']))
+	benchutil.report("API request path (%d requests per scenario)" % count,rows)
+	with open(output,"w") as f:
+		json.dump({
+			'benchmark': "api_request_path",
+			'timestamp': time.time(),
+			'python': platform.python_version(),
+			'backend': "memorydatastore",
+			'dataset_size': DATASET_SIZE,
+			'count': count,
+			'scenarios': results
+		},f,indent=2,sort_keys=True)
+	print "Results saved to %s" % output
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 500,sys.argv[2] if len(sys.argv) > 2 else "api_request_path.json")
@@ -0,0 +1,62 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, os, time, gc
+
+# add python libraries, in the same way as application.py
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+code_paths = [
+	os.path.join(root_path,'app'),
+	os.path.join(root_path,'lib'),
+	os.path.join(root_path,'lib3')
+]
+for path in code_paths:
+	if (path not in sys.path) and os.path.exists(path): sys.path.insert(0,path)
+
+def setup_sdk():
+	"""Add the App Engine SDK to the python path, using GAE_SDK or the location of dev_appserver.py"""
+	sdk_path = os.environ.get('GAE_SDK')
+	if not sdk_path:
+		for path in os.environ.get('PATH','').split(os.pathsep):
+			if os.path.exists(os.path.join(path,'dev_appserver.py')):
+				sdk_path = os.path.dirname(os.path.realpath(os.path.join(path,'dev_appserver.py')))
+				break
+	if not sdk_path:
+		raise EnvironmentError("Missing App Engine SDK (set GAE_SDK or add dev_appserver.py to PATH)")
+	if sdk_path not in sys.path:
+		sys.path.insert(0,sdk_path)
+	import dev_appserver
+	dev_appserver.fix_sys_path()
+
+def setup_testbed():
+	"""Activate datastore and memcache stubs, return testbed object"""
+	from google.appengine.ext import testbed
+	bed = testbed.Testbed()
+	bed.activate()
+	bed.init_datastore_v3_stub()
+	bed.init_memcache_stub()
+	return bed
+
+def measure(func,count,repeat=3):
+	"""Return best time in seconds for calling func count times"""
+	best = None
+	for i in xrange(repeat):
+		gc.collect()
+		start = time.time()
+		for j in xrange(count):
+			func()
+		elapsed = time.time() - start
+		if best==None or elapsed < best:
+			best = elapsed
+	return best
+
+def report(title,rows):
+	"""Print a table of (name,value) rows"""
+	print title
+	print "-" * len(title)
+	for (name,value) in rows:
+		print "  %-40s %s" % (name,value)
+	print ""
@@ -0,0 +1,123 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark bulk import and export of newline-delimited JSON
+
+Requests are made in-process through the WSGI interface of application.app,
+with AddressBookEntry stored in the in-memory data store. A request body of
+count records, with one invalid record in every INVALID_INTERVAL, is posted
+to the _import endpoint, and then all stored records are read back from the
+_export endpoint. Reports the time and records per second for each, and the
+growth in peak resident memory, which for the import includes the stored
+entities, and saves the results as JSON. Run with the App Engine SDK on the path:
+
+  python bench/bulk_ndjson.py [count] [output]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, gc, time, json, platform, resource
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+if benchutil.root_path not in sys.path:
+	sys.path.insert(0,benchutil.root_path)
+
+# GAE imports
+import webapp2
+
+# appengineapi-kit imports
+from appengineapi_kit import memorydatastore
+from test import apihandler
+import application
+
+# one record in this many is missing the name, which is reported as an error
+INVALID_INTERVAL = 1000
+
+def setup_store():
+	"""Store AddressBookEntry objects in an empty in-memory data store, without an entity cache"""
+	model = apihandler.AddressBookEntry
+	model.proxy = memorydatastore.DataStore(model.get_kind(),storage=memorydatastore.Storage())
+	model.entity_cache = None
+	return model
+
+def make_body(count):
+	"""Return request body of count records as newline-delimited JSON"""
+	lines = [ ]
+	for i in xrange(count):
+		if i % INVALID_INTERVAL==INVALID_INTERVAL - 1:
+			lines.append(json.dumps({ 'email': "invalid%s@example.com" % i }))
+		else:
+			lines.append(json.dumps({ 'name': "Entry %s" % i, 'email': "entry%s@example.com" % i }))
+	return "\n".join(lines) + "\n"
+
+def max_rss():
+	"""Return peak resident memory of the process in kilobytes (bytes on Mac OS X)"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_request(method,path,body=None):
+	"""Return tuple of (response,seconds,peak memory growth) for a request"""
+	request = webapp2.Request.blank(path)
+	request.method = method
+	if body != None:
+		request.body = body
+		request.content_type = "application/x-ndjson"
+	gc.collect()
+	rss = max_rss()
+	start = time.time()
+	response = request.get_response(application.app)
+	elapsed = time.time() - start
+	return (response,elapsed,max_rss() - rss)
+
+def run(count,output):
+	model = setup_store()
+	body = make_body(count)
+	(response,import_time,import_rss) = run_request("POST","/api/test/addressbook_entry/_import",body)
+	import_status = response.status_int
+	summary = json.loads(response.body)
+	del body
+	(response,export_time,export_rss) = run_request("GET","/api/test/addressbook_entry/_export")
+	exported = response.body.count("\n")
+	results = {
+		'import': {
+			'status': import_status,
+			'records': count,
+			'imported': summary.get('imported'),
+			'error_count': summary.get('error_count'),
+			'seconds': import_time,
+			'records_per_sec': count / import_time,
+			'max_rss_growth': import_rss
+		},
+		'export': {
+			'status': response.status_int,
+			'records': exported,
+			'bytes': len(response.body),
+			'seconds': export_time,
+			'records_per_sec': exported / export_time,
+			'max_rss_growth': export_rss
+		}
+	}
+	rows = [ ]
+	for name in ('import','export'):
+		result = results[name]
+		rows.append(("%s: seconds" % name,"%.2f" % result['seconds']))
+		rows.append(("%s: records per sec" % name,"%.0f" % result['records_per_sec']))
+		rows.append(("%s: peak memory growth" % name,"%d" % result['max_rss_growth']))
+	rows.append(("import: records stored / errors","%s / %s" % (summary.get('imported'),summary.get('error_count'))))
+	benchutil.report("Bulk NDJSON import and export (%d records)" % count,rows)
+	with open(output,"w") as f:
+		json.dump({
+			'benchmark': "bulk_ndjson",
+			'timestamp': time.time(),
+			'python': platform.python_version(),
+			'backend': "memorydatastore",
+			'count': count,
+			'batch_size': apihandler.RequestHandler.IMPORT_BATCH_SIZE,
+			'page_size': apihandler.RequestHandler.EXPORT_PAGE_SIZE,
+			'results': results
+		},f,indent=2,sort_keys=True)
+	print "Results saved to %s" % output
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,sys.argv[2] if len(sys.argv) > 2 else "bulk_ndjson.json")
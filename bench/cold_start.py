@@ -0,0 +1,93 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark instance start-up
+
+Each run starts a new Python process, which imports application.py and makes
+requests in-process through the WSGI interface of application.app, as a new
+App Engine instance would. Runs are made with and without a warmup request
+before the first API request. Reports the median time to import the
+application, warm up, and serve the first and second requests, and the number
+of modules loaded, and saves the results as JSON. The first API request does
+not read from the data store. Run with the App Engine SDK on the path:
+
+  python bench/cold_start.py [count] [output]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, os, time, json, platform, subprocess
+
+# benchmark imports
+import benchutil
+
+# request made as the first and second API requests
+API_PATH = "/api/test/unknown_kind"
+
+def child(warmup):
+	"""Start the application in this process, and print the timings as JSON"""
+	benchutil.setup_sdk()
+	if benchutil.root_path not in sys.path:
+		sys.path.insert(0,benchutil.root_path)
+	modules = len(sys.modules)
+	start = time.time()
+	import application
+	import webapp2
+	from appengineapi_kit import startup
+	results = { 'import': time.time() - start }
+	results['modules_after_import'] = len(sys.modules) - modules
+	if warmup:
+		start = time.time()
+		webapp2.Request.blank("/_ah/warmup").get_response(application.app)
+		results['warmup'] = time.time() - start
+	for name in ('first_request','second_request'):
+		start = time.time()
+		webapp2.Request.blank(API_PATH).get_response(application.app)
+		results[name] = time.time() - start
+	results['modules_after_requests'] = len(sys.modules) - modules
+	results['startup'] = startup.get_timings()
+	print json.dumps(results)
+
+def run_child(warmup):
+	"""Return timings from a new process"""
+	args = [ sys.executable,os.path.abspath(__file__),"--child" ]
+	if warmup:
+		args.append("--warmup")
+	output = subprocess.check_output(args,env=os.environ)
+	return json.loads(output.strip().split("\n")[-1])
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def run(count,output):
+	results = { }
+	rows = [ ]
+	for (name,warmup) in (("cold",False),("warmup",True)):
+		runs = [ run_child(warmup) for i in xrange(count) ]
+		result = { }
+		for phase in ('import','warmup','first_request','second_request'):
+			if phase in runs[0]:
+				result[phase + "_ms"] = median([ values[phase] for values in runs ]) * 1000.0
+				rows.append(("%s: %s msec" % (name,phase),"%.1f" % result[phase + "_ms"]))
+		for phase in ('modules_after_import','modules_after_requests'):
+			result[phase] = median([ values[phase] for values in runs ])
+			rows.append(("%s: %s" % (name,phase),"%d" % result[phase]))
+		results[name] = result
+	benchutil.report("Instance start-up (median of %d processes)" % count,rows)
+	with open(output,"w") as f:
+		json.dump({
+			'benchmark': "cold_start",
+			'timestamp': time.time(),
+			'python': platform.python_version(),
+			'count': count,
+			'results': results
+		},f,indent=2,sort_keys=True)
+	print "Results saved to %s" % output
+
+if __name__ == "__main__":
+	if "--child" in sys.argv:
+		child("--warmup" in sys.argv)
+	else:
+		args = [ arg for arg in sys.argv[1:] if not arg.startswith("--") ]
+		run(int(args[0]) if len(args) > 0 else 10,args[1] if len(args) > 1 else "cold_start.json")
@@ -0,0 +1,53 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark the cost of constructing Model objects from datastore entities
+
+Compares a DataStore which generates a new proxy class for each entity
+(the previous behaviour) with the cached per-entity-name class registry.
+Run with the App Engine SDK on the path:
+
+  python bench/model_construction.py [count]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+
+# appengineapi-kit imports
+from appengineapi_kit import gaedatastore
+from test import apihandler
+
+class UncachedDataStore(gaedatastore.DataStore):
+	"""DataStore which generates a new model class on every call"""
+	def get_model_class(self):
+		return type(self.get_entity_name(),(gaedatastore.DataModel,),{ })
+
+def run(count):
+	bed = benchutil.setup_testbed()
+	model = apihandler.AddressBookEntry
+	cached_store = model.proxy
+	entity_name = cached_store.get_entity_name()
+	entities = [ cached_store.get_model_class()(name="Entry %s" % i,email="entry%s@example.com" % i) for i in xrange(count) ]
+	def decode():
+		for entity in entities:
+			model(_proxy=entity)
+	rows = [ ]
+	try:
+		for (name,store) in (("uncached",UncachedDataStore(entity_name)),("cached",cached_store)):
+			model.proxy = store
+			elapsed = benchutil.measure(decode,1)
+			classes = set([ store.get_model_class() for i in xrange(count) ])
+			rows.append(("%s: usec per entity" % name,"%.2f" % (elapsed * 1e6 / count)))
+			rows.append(("%s: classes per %d entities" % (name,count),len(classes)))
+	finally:
+		model.proxy = cached_store
+		bed.deactivate()
+	benchutil.report("Model construction (%d entities)" % count,rows)
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
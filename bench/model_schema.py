@@ -0,0 +1,68 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark building and serializing Model objects
+
+Measures construction and as_json for AddressBookEntry objects, and the
+per-instance reflection pass over the class which the compiled schema
+replaces. Objects are stored in the in-memory data store before they are
+serialized, as they are when returned in responses. Run with the App Engine
+SDK on the path:
+
+  python bench/model_schema.py [count]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+
+# appengineapi-kit imports, where the test handler is imported first since
+# it imports the api module, which must be imported before the others
+from test import apihandler
+from appengineapi_kit import models, memorydatastore
+
+def reflect_properties(model):
+	"""The reflection pass previously made by each Model.__init__"""
+	properties = { }
+	for name in vars(model):
+		value = getattr(model,name)
+		if isinstance(value,models.ModelProperty):
+			properties[name] = value
+	return properties
+
+def setup_store():
+	"""Store AddressBookEntry objects in an empty in-memory data store, without an entity cache"""
+	model = apihandler.AddressBookEntry
+	model.proxy = memorydatastore.DataStore(model.get_kind(),storage=memorydatastore.Storage())
+	model.entity_cache = None
+	return model
+
+def run(count):
+	model = setup_store()
+	values = [ { 'name': "Entry %s" % i, 'email': "entry%s@example.com" % i } for i in xrange(count) ]
+	entities = [ ]
+	def build():
+		del entities[:]
+		for value in values:
+			entities.append(model(**value))
+	def serialize():
+		for entity in entities:
+			entity.as_json()
+	def reflect():
+		for value in values:
+			reflect_properties(model)
+	rows = [ ]
+	for (name,func) in (("build",build),("as_json",serialize),("reflection pass (removed)",reflect)):
+		elapsed = benchutil.measure(func,1)
+		rows.append(("%s: usec per entity" % name,"%.2f" % (elapsed * 1e6 / count)))
+		if func==build:
+			# objects are serialized with their keys once stored
+			model.put_multi(entities)
+	benchutil.report("Model schema (%d entities)" % count,rows)
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
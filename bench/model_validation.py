@@ -0,0 +1,94 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark validating records for a model with many properties
+
+Measures Model.update and RequestHandler._decode_request_model for records
+with string and integer properties, and the validation pass made before the
+validators were compiled. Run with the App Engine SDK on the path:
+
+  python bench/model_validation.py [count]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+
+# appengineapi-kit imports
+from appengineapi_kit import api, models, gaedatastore
+
+# number of string and integer properties in each record
+PROPERTY_COUNT = 20
+
+def make_model():
+	attrs = { 'proxy': gaedatastore.DataStore("bench_record") }
+	for i in xrange(PROPERTY_COUNT):
+		attrs['text%d' % i] = models.StringProperty(notnull=True,minlength=0,maxlength=100)
+		attrs['number%d' % i] = models.IntegerProperty(notnull=False,minvalue=0,maxvalue=1000000)
+	return type("BenchRecord",(models.Model,),attrs)
+
+def make_record(i):
+	record = { '_type': "bench_record" }
+	for j in xrange(PROPERTY_COUNT):
+		record['text%d' % j] = "Record %s value %s" % (i,j)
+		record['number%d' % j] = i + j
+	return record
+
+def legacy_validate(prop,name,value):
+	"""The validation previously made by StringProperty.validate and IntegerProperty.validate"""
+	if value==None and prop._notnull:
+		raise ValueError("Value cannot be NULL for property '%s'" % name)
+	if isinstance(prop,models.StringProperty):
+		if value and isinstance(value,basestring) != True:
+			raise ValueError("Not a string for property '%s'" % name)
+		if value and prop._minlength != None and len(value) < prop._minlength:
+			raise ValueError("MINLENGTH condition fails for property '%s'" % name)
+		if value and prop._maxlength != None and len(value) > prop._maxlength:
+			raise ValueError("MAXLENGTH condition fails for property '%s'" % name)
+	else:
+		if value and (isinstance(value,int) or isinstance(value,long)) != True:
+			raise ValueError("Not an integer for property '%s'" % name)
+		if value and prop._minvalue != None and value < prop._minvalue:
+			raise ValueError("MINVALUE condition fails for property '%s'" % name)
+		if value and prop._maxvalue != None and value > prop._maxvalue:
+			raise ValueError("MAXVALUE condition fails for property '%s'" % name)
+	return value
+
+def run(count):
+	bed = benchutil.setup_testbed()
+	model = make_model()
+	handler_class = type("BenchHandler",(api.RequestHandler,),{ 'models': (model,) })
+	handler = handler_class()
+	records = [ make_record(i) for i in xrange(count) ]
+	properties = model._get_properties()
+	def decode():
+		for record in records:
+			handler._decode_request_model("bench_record",record)
+	def legacy():
+		for record in records:
+			for (name,prop) in properties.iteritems():
+				legacy_validate(prop,name,record.get(name))
+	def validate():
+		for record in records:
+			model._schema.validate_record(record)
+	entity = model(**records[0])
+	entity.put()
+	updates = [ dict([ (name,value) for (name,value) in record.iteritems() if name != '_type' ]) for record in records ]
+	def update():
+		for values in updates:
+			entity.update(values)
+	try:
+		rows = [ ]
+		for (name,func) in (("_decode_request_model",decode),("validate_record",validate),("validation pass (removed)",legacy),("update",update)):
+			elapsed = benchutil.measure(func,1)
+			rows.append(("%s: usec per record" % name,"%.2f" % (elapsed * 1e6 / count)))
+	finally:
+		bed.deactivate()
+	benchutil.report("Model validation (%d records of %d properties)" % (count,PROPERTY_COUNT * 2),rows)
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,62 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark encoding feeds for responses
+
+Reports the bytes on the wire and encode time for feeds of 1k, 10k and 100k
+AddressBookEntry items, comparing the django simplejson encoder with default
+separators against the compact encoder, uncompressed and with gzip and
+deflate content encodings. Run with the App Engine SDK on the path:
+
+  python bench/response_encoding.py
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, time
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+
+# GAE imports
+from django.utils import simplejson
+
+# appengineapi-kit imports, where the test handler is imported first since
+# it imports the api module, which must be imported before the others
+from test import apihandler
+from appengineapi_kit import query, encoding
+
+def make_feed(model,size):
+	feed = query.Feed(model)
+	for i in xrange(size):
+		feed.append(model(name="Entry %s" % i,email="entry%s@example.com" % i))
+	return feed
+
+def encode_body(feed,encode,content_encoding):
+	"""Return the response body for feed, as written by response_json"""
+	chunks = list(feed.iter_json(encode)) + [ "\n" ]
+	if content_encoding==None:
+		return "".join(chunks)
+	compressor = encoding.Compressor(content_encoding)
+	return "".join([ compressor.compress(chunk) for chunk in chunks ]) + compressor.flush()
+
+def run(sizes):
+	bed = benchutil.setup_testbed()
+	rows = [ ]
+	try:
+		for size in sizes:
+			feed = make_feed(apihandler.AddressBookEntry,size)
+			for (name,encode) in (("simplejson",simplejson.dumps),("compact",encoding.dumps)):
+				for content_encoding in (None,) + encoding.CONTENT_ENCODINGS:
+					start = time.time()
+					body = encode_body(feed,encode,content_encoding)
+					elapsed = time.time() - start
+					label = "%d items: %s %s" % (size,name,content_encoding or "identity")
+					rows.append((label,"%d bytes, %.1f msec" % (len(body),elapsed * 1e3)))
+	finally:
+		bed.deactivate()
+	benchutil.report("Response encoding (%s backend)" % encoding.json_backend.__name__,rows)
+
+if __name__ == "__main__":
+	run([ int(arg) for arg in sys.argv[1:] ] or (1000,10000,100000))
@@ -0,0 +1,52 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+"""Benchmark route dispatch for handlers with increasing numbers of routes
+
+Each handler has one route per resource name, and requests are made for
+the last declared route, which is the worst case for a linear scan. Run
+with the App Engine SDK on the path:
+
+  python bench/route_dispatch.py [count]
+"""
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, re
+
+# benchmark imports
+import benchutil
+benchutil.setup_sdk()
+
+# appengineapi-kit imports
+from appengineapi_kit import api
+
+def get_object(self,key):
+	return key
+
+def make_handler(size):
+	routes = [ (api.RequestHandler.METHOD_GET,r"^/?resource%d/([1-9][0-9]*)$" % i,get_object) for i in xrange(size) ]
+	return type("Handler%d" % size,(api.RequestHandler,),{ 'routes': tuple(routes) })
+
+def linear_route(handler,method,path):
+	"""The linear scan previously made by RequestHandler.route_request"""
+	for route in handler.routes:
+		if route[0] != method: continue
+		m = re.match(route[1],path)
+		if not m: continue
+		return route[2](handler,*m.groups())
+
+def run(count):
+	rows = [ ]
+	for size in (5,50,500):
+		handler = make_handler(size)()
+		path = "/resource%d/42" % (size - 1)
+		method = api.RequestHandler.METHOD_GET
+		linear = benchutil.measure(lambda: linear_route(handler,method,path),count)
+		compiled = benchutil.measure(lambda: handler.route_request(method,path),count)
+		rows.append(("%d routes: linear usec per request" % size,"%.2f" % (linear * 1e6 / count)))
+		rows.append(("%d routes: compiled usec per request" % size,"%.2f" % (compiled * 1e6 / count)))
+	benchutil.report("Route dispatch (%d requests)" % count,rows)
+
+if __name__ == "__main__":
+	run(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -4,27 +4,30 @@
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
 # Python imports
-import re, logging
+import re, time, math, logging, hashlib, itertools, random, StringIO, email.utils
 
 # GAE imports
 import webapp2
-from django.utils import simplejson
 
 # appengineapi-kit imports
-from appengineapi_kit import query, models
+from appengineapi_kit import query, models, encoding, instrument, throttle, startup
 
 class HTTPException(Exception):
 	""" HTTP specific error response """
 
 	STATUS_OK = 200
+	STATUS_NOTMODIFIED = 304
 	STATUS_BADREQUEST = 400
 	STATUS_NOTFOUND = 404
+	STATUS_TOOMANYREQUESTS = 429
 	STATUS_SERVERERROR = 500
 	
 	REASONS = {
 		STATUS_OK: "OK",
+		STATUS_NOTMODIFIED: "Not Modified",
 		STATUS_BADREQUEST: "Bad Request",
 		STATUS_NOTFOUND: "Resource not found",
+		STATUS_TOOMANYREQUESTS: "Too Many Requests",
 		STATUS_SERVERERROR: "Server Error"
 	}
 	
@@ -40,8 +43,8 @@ class HTTPException(Exception):
 	def get_reason(self):
 		if self._reason:
 			return self._reason
-		if self._code in REASONS:
-			return REASONS[self._code]
+		if self._code in HTTPException.REASONS:
+			return HTTPException.REASONS[self._code]
 		return "Error Code %s" % self.code
 	reason = property(get_reason)
 	
@@ -49,35 +52,153 @@ class HTTPException(Exception):
 	def as_json(self):
 		return { '_type': type(self).__name__, 'code': self.code, 'reason': self.reason }
 
+def raw_body(func):
+	"""Decorator for route methods which read the request body themselves, so
+	that POST and PUT bodies are not decoded and passed as the last argument"""
+	func.raw_body = True
+	return func
+
+class RouteTable(object):
+	"""Routes for a RequestHandler class, compiled into per-method tables"""
+
+	# matches route patterns which start with a literal path segment, for
+	# example r"^/?addressbook_entry/([1-9][0-9]*)$"
+	LITERAL_SEGMENT = re.compile(r"^\^?(?:/|\\/)?[?*+]?([\w\-]+)(?:/|\\/|\$|$)")
+
+	def __init__(self,routes):
+		assert isinstance(routes,tuple) or isinstance(routes,list),"RouteTable.__init__: Invalid routes class property"
+		# collect routes by method, keeping the order in which they are declared
+		literals = { }
+		wildcards = { }
+		for (order,route) in enumerate(routes):
+			assert isinstance(route,tuple) or isinstance(route,list),"RouteTable.__init__: Invalid route"
+			assert len(route) >= 3,"RouteTable.__init__: Invalid route"
+			(method,pattern,func) = route[0:3]
+			assert callable(func),"RouteTable.__init__: Invalid route function for %s" % pattern
+			segment = self._literal_segment(pattern)
+			entry = (order,re.compile(pattern),func)
+			if segment==None:
+				wildcards.setdefault(method,[ ]).append(entry)
+			else:
+				literals.setdefault(method,{ }).setdefault(segment,[ ]).append(entry)
+		# for each method, make a table of candidate routes keyed by the first
+		# path segment, and the list of routes to try for any other segment
+		self._methods = { }
+		for method in set(literals.keys() + wildcards.keys()):
+			wildcard = wildcards.get(method,[ ])
+			segments = { }
+			for (segment,entries) in literals.get(method,{ }).iteritems():
+				segments[segment] = self._candidates(entries + wildcard)
+			self._methods[method] = (segments,self._candidates(wildcard))
+
+	# PRIVATE METHODS
+	def _literal_segment(self,pattern):
+		"""Return the literal first path segment matched by a pattern, or None"""
+		if not isinstance(pattern,basestring) or "|" in pattern:
+			return None
+		m = RouteTable.LITERAL_SEGMENT.match(pattern)
+		if not m:
+			return None
+		return m.group(1)
+	def _candidates(self,entries):
+		"""Return tuple of (regex,func) in declaration order"""
+		return tuple([ (regex,func) for (order,regex,func) in sorted(entries) ])
+
+	# PUBLIC METHODS
+	def match(self,method,path):
+		"""Return (func,args) for the first route matching method and path, or None"""
+		table = self._methods.get(method)
+		if table==None:
+			return None
+		(segments,routes) = table
+		if segments:
+			routes = segments.get(path.lstrip("/").partition("/")[0],routes)
+		for (regex,func) in routes:
+			m = regex.match(path)
+			if m:
+				return (func,m.groups())
+		return None
+
+class RequestHandlerType(type):
+	"""Metaclass which compiles the routes and models once for each RequestHandler class"""
+	def __init__(cls,name,bases,attrs):
+		super(RequestHandlerType,cls).__init__(name,bases,attrs)
+		if 'routes' in attrs:
+			cls._route_table = RouteTable(attrs['routes'])
+		else:
+			cls._route_table = None
+		cls._models = cls._model_table(attrs.get('models'))
+
+	# PRIVATE METHODS
+	def _model_table(cls,handler_models):
+		"""Return hash of models which are handled by the API, keyed by kind"""
+		table = { }
+		if handler_models==None:
+			return table
+		assert isinstance(handler_models,tuple) or isinstance(handler_models,list),"RequestHandlerType: invalid 'models' property"
+		for model in handler_models:
+			assert issubclass(model,models.Model)
+			model_name = model.get_kind()
+			if model_name in table:
+				raise ValueError("Two models with same name '%s'" % model_name)
+			table[model_name] = model
+		return table
+
 class RequestHandler(webapp2.RequestHandler):
 	"""Class to handle generic AJAX requests"""
+	__metaclass__ = RequestHandlerType
 
 	# CONSTANTS
 	METHOD_GET = 0
 	METHOD_POST = 1
 	METHOD_DELETE = 2
 	METHOD_PUT = 3
+
+	# responses of at least this many bytes are compressed, or None to disable compression
+	COMPRESSION_THRESHOLD = 1024
+
+	# bulk import and export of newline-delimited JSON: objects are stored in
+	# batches of IMPORT_BATCH_SIZE, up to IMPORT_MAX_ERRORS invalid lines are
+	# reported, and objects are exported in pages of EXPORT_PAGE_SIZE
+	NDJSON_MEDIA_TYPE = "application/x-ndjson"
+	IMPORT_BATCH_SIZE = 500
+	IMPORT_MAX_ERRORS = 100
+	EXPORT_PAGE_SIZE = 500
+	READ_CHUNK_SIZE = 65536
+
+	# instrumentation settings, which are enabled and overridden by an
+	# 'instrument' dictionary in the application registry. Requests are
+	# profiled with cProfile at the sample rate when profile_threshold is
+	# set, and statistics are logged for requests slower than the threshold
+	INSTRUMENT_DEFAULTS = {
+		'enabled': True,
+		'header': True,
+		'log': False,
+		'profile_threshold': None,
+		'profile_sample_rate': 1.0,
+		'profile_lines': 40
+	}
+
+	# request headers which responses to coalesced requests depend on, including
+	# those which may identify the user
+	COALESCE_HEADERS = ('Accept','Accept-Encoding','If-None-Match','If-Modified-Since','Authorization','Cookie','X-API-Key')
+
+	# throttling settings, which are enabled and overridden by a 'throttle'
+	# dictionary in the application registry. When rate is set, each client
+	# may make rate requests per second with bursts of up to burst requests,
+	# and is identified by the API key returned by get_api_key or else the
+	# remote address. When coalesce is True, identical GET requests made while
+	# one is in progress wait for it and share its response, where requests
+	# are identical when the coalesce_headers have the same values
+	THROTTLE_DEFAULTS = {
+		'rate': None,
+		'burst': None,
+		'max_clients': 10000,
+		'coalesce': False,
+		'coalesce_headers': COALESCE_HEADERS
+	}
 	
-	# CONSTRUCTOR
-	def __init__(self,*args):
-		webapp2.RequestHandler.__init__(self,*args)
-		# make hash of models which are handled by the API
-		self._models = { }
-		if 'models' in vars(self.__class__):
-			assert isinstance(self.models,tuple) or isinstance(self.models,list),"RequestHandler.__init__: invalid 'models' property"
-			for model in self.models:
-				assert issubclass(model,models.Model)
-				model_name = model.get_kind()
-				if model_name in self._models:
-					raise ValueError("Two models with same name '%s'" % model_name)
-				self._models[model_name] = model
 	# PRIVATE METHODS
-	def _get_routes(self):
-		"""Return tuple of routes"""
-		if not 'routes' in vars(self.__class__):
-			return None
-		assert isinstance(self.routes,tuple) or isinstance(self.routes,list),"_get_routes: Invalid routes class property"
-		return self.routes
 	def _decode_method(self):
 		"""Decode the method into constants"""
 		if self.request.method=='GET':
@@ -95,64 +216,497 @@ class RequestHandler(webapp2.RequestHandler):
 		model = self._models.get(model_name)
 		if model==None or not issubclass(model,models.Model):
 			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request of type '%s'" % model_name)
-		return (model)(**json)
+		# names starting with an underscore, such as _type and _key, are not properties
+		return (model)(**dict([ (name,value) for (name,value) in json.iteritems() if not name.startswith("_") ]))
 	def _decode_request(self):
-		"""Decode request body from JSON into a Python object"""
+		"""Decode request body into a Python object, or list of objects, using the
+		codec for the Content-Type header (JSON when the type is not registered)"""
+		with instrument.timer("decode"):
+			return self._decode_request_body()
+	def _decode_request_body(self):
 		try:
 			if self.request.body:
-				request = simplejson.loads(self.request.body)
+				codec = encoding.get_request_codec(self.request.headers.get('Content-Type'))
+				request = codec.loads(self.request.body)
 				if(isinstance(request,dict) and request.get('_type')):
 					request = self._decode_request_model(request.get('_type'),request)
+				elif isinstance(request,list):
+					request = [ self._decode_request_model(item.get('_type'),item) if isinstance(item,dict) and item.get('_type') else item for item in request ]
 				return request
 			else:
 				return None
-		except simplejson.JSONDecodeError, e:
-			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request: %s" % e)
 		except KeyError, e:
 			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request: %s" % e)
-
-	# PUBLIC METHODS
-	def response_json(self,obj):
-		"""Send response to client"""
-		self.response.headers['Content-Type'] = "application/json"
+		except ValueError, e:
+			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request: %s" % e)
+	def _get_model(self,model_name):
+		"""Return model class handled by the API for a kind"""
+		model = self._models.get(model_name)
+		if model==None:
+			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request of type '%s'" % model_name)
+		return model
+	def _decode_keys(self,keys):
+		"""Return list of long keys, or raise a bad request error"""
+		try:
+			keys = [ long(key) for key in keys ]
+		except (TypeError,ValueError):
+			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request, invalid keys")
+		if len(keys)==0 or min(keys) <= 0:
+			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request, invalid keys")
+		return keys
+	def _iter_body_lines(self):
+		"""Yield lines of the request body, reading the body file in chunks"""
+		body_file = self.request.body_file
+		remainder = ""
+		while True:
+			chunk = body_file.read(self.READ_CHUNK_SIZE)
+			if not chunk:
+				break
+			lines = (remainder + chunk).split("\n")
+			remainder = lines.pop()
+			for line in lines:
+				yield line
+		if remainder:
+			yield remainder
+	def _store_import(self,model,created,updates):
+		"""Store a batch of new objects, and update stored objects from a list of
+		(line,key,values) tuples. Return tuple of (stored,errors) where errors
+		are reported for the lines with keys of objects which are not stored, or
+		with invalid values"""
+		errors = [ ]
+		changed = list(created)
+		if len(updates):
+			stored = model.get_by_keys([ key for (line_number,key,values) in updates ])
+			for ((line_number,key,values),obj) in zip(updates,stored):
+				if obj==None:
+					errors.append({ 'line': line_number, 'reason': "no %s with key %s" % (model.get_kind(),key) })
+					continue
+				try:
+					obj.set_values(values)
+				except (TypeError,ValueError), e:
+					errors.append({ 'line': line_number, 'reason': "%s" % e })
+					continue
+				changed.append(obj)
+		if len(changed):
+			model.put_multi(changed)
+		return (len(changed),errors)
+	def _iter_export(self,model):
+		"""Yield newline-delimited JSON for all objects of a model, one page at a time"""
+		cursor = None
+		while True:
+			feed = model.get_query().execute(limit=self.EXPORT_PAGE_SIZE,stream=True,cursor=cursor)
+			lines = [ encoding.dumps(item.as_json()) for item in feed ]
+			if len(lines):
+				yield "\n".join(lines) + "\n"
+			cursor = feed.cursor
+			if cursor==None:
+				break
+	def _is_conditional(self):
+		"""Return True if conditional responses apply to the request method"""
+		return self.request.method in ('GET','HEAD')
+	def _matches_etag(self,etag):
+		"""Return True if the If-None-Match header matches the entity tag"""
+		for value in self.request.headers.get('If-None-Match').split(","):
+			value = value.strip()
+			if value.startswith("W/"):
+				value = value[2:]
+			if value=="*" or value.strip('"')==etag:
+				return True
+		return False
+	def _not_modified_since(self,last_modified):
+		"""Return True if the If-Modified-Since header is not before the last modified time"""
+		since = email.utils.parsedate_tz(self.request.headers.get('If-Modified-Since'))
+		if since==None:
+			return False
+		return int(last_modified) <= email.utils.mktime_tz(since)
+	def _add_vary(self,name):
+		"""Add request header name to the Vary response header"""
+		vary = self.response.headers.get('Vary')
+		if not vary:
+			self.response.headers['Vary'] = name
+		elif name not in [ value.strip() for value in vary.split(",") ]:
+			self.response.headers['Vary'] = "%s, %s" % (vary,name)
+	def _get_response_codec(self):
+		"""Return codec for the response body, negotiated from the Accept header"""
+		if len(encoding.codecs_by_media_type) > 1:
+			self._add_vary("Accept")
+		return encoding.negotiate_codec(self.request.headers.get('Accept'))
+	def _get_content_encoding(self):
+		"""Return content encoding accepted by the client, or None if the response
+		should not be compressed. Bodies smaller than the compression threshold are
+		sent uncompressed, but have the same entity tag as compressed ones"""
+		if self.COMPRESSION_THRESHOLD==None:
+			return None
+		self._add_vary("Accept-Encoding")
+		return encoding.negotiate_encoding(self.request.headers.get('Accept-Encoding'))
+	def _suffix_etag(self,etag,codec,content_encoding):
+		"""Return entity tag with suffixes for the codec and content encoding, so
+		that each representation of the resource has a different entity tag"""
+		if codec is not encoding.default_codec:
+			etag = "%s-%s" % (etag,codec.NAME)
+		if content_encoding != None:
+			etag = "%s-%s" % (etag,content_encoding)
+		return etag
+	def _read_ahead(self,chunks,size):
+		"""Return tuple of (chunks,bytes) for the chunks read from an iterator until
+		they total at least size bytes or there are no more"""
+		head = [ ]
+		total = 0
+		for chunk in chunks:
+			head.append(chunk)
+			total += len(chunk)
+			if total >= size:
+				break
+		return (head,total)
+	def _write_body(self,chunks,content_encoding=None):
+		"""Write chunks of the response body, compressing them with the content encoding
+		once they total at least the compression threshold"""
+		if content_encoding != None:
+			chunks = iter(chunks)
+			(head,head_size) = self._read_ahead(chunks,self.COMPRESSION_THRESHOLD)
+			if head_size < self.COMPRESSION_THRESHOLD:
+				content_encoding = None
+			chunks = itertools.chain(head,chunks)
+		size = 0
+		if content_encoding==None:
+			for chunk in chunks:
+				self.response.write(chunk)
+				size += len(chunk)
+		else:
+			self.response.headers['Content-Encoding'] = content_encoding
+			compressor = encoding.Compressor(content_encoding)
+			for chunk in chunks:
+				data = compressor.compress(chunk)
+				if data:
+					self.response.write(data)
+					size += len(data)
+			data = compressor.flush()
+			self.response.write(data)
+			size += len(data)
+		instrument.add_size("response",size)
+	def _get_instrument_config(self):
+		"""Return instrumentation settings, or None when instrumentation is not enabled"""
+		registry = getattr(getattr(self,'app',None),'registry',None)
+		if not registry or registry.get('instrument')==None:
+			return None
+		config = dict(RequestHandler.INSTRUMENT_DEFAULTS)
+		config.update(registry['instrument'])
+		if not config['enabled']:
+			return None
+		return config
+	def _get_throttle(self):
+		"""Return tuple of (settings,limiter,flight) for throttling, which are shared
+		by the requests of the application, or None when throttling is not enabled"""
+		registry = getattr(getattr(self,'app',None),'registry',None)
+		if not registry or registry.get('throttle')==None:
+			return None
+		throttle_state = registry.get('throttle_state')
+		if throttle_state==None:
+			config = dict(RequestHandler.THROTTLE_DEFAULTS)
+			config.update(registry['throttle'])
+			limiter = None
+			if config['rate']:
+				limiter = throttle.RateLimiter(config['rate'],config['burst'],config['max_clients'])
+			flight = throttle.SingleFlight() if config['coalesce'] else None
+			throttle_state = registry.setdefault('throttle_state',(config,limiter,flight))
+		return throttle_state
+	def _get_client_key(self):
+		"""Return key which identifies the client for rate limiting"""
+		api_key = self.get_api_key()
+		if api_key:
+			return "key:%s" % api_key
+		return "addr:%s" % self.request.remote_addr
+	def _get_coalesce_key(self,config,path):
+		"""Return key for the GET requests which can share the response to this request"""
+		values = [ self.__class__.__name__,path,self.request.query_string ]
+		values.extend([ self.request.headers.get(name) for name in config['coalesce_headers'] ])
+		return tuple(values)
+	def _dispatch_instrumented(self):
+		"""Dispatch the request, recording timings, data store calls and payload
+		sizes when instrumentation is enabled in the application registry"""
+		config = self._get_instrument_config()
+		if config==None:
+			return self._dispatch_request()
+		recorder = instrument.begin(self.request.method,self.request.path)
+		instrument.add_size("request",self.request.content_length or 0)
+		profiler = None
+		if config['profile_threshold'] != None and random.random() < config['profile_sample_rate']:
+			# the profiler is only imported when a request is profiled
+			import cProfile
+			profiler = cProfile.Profile()
+		try:
+			if profiler:
+				return profiler.runcall(self._dispatch_request)
+			return self._dispatch_request()
+		finally:
+			if profiler and recorder.get_elapsed() >= config['profile_threshold']:
+				recorder.profile = self._format_profile(profiler,config['profile_lines'])
+				logging.warning("Slow request %s %s (%.1f ms)\n%s" % (recorder.method,recorder.path,recorder.get_elapsed() * 1000.0,recorder.profile))
+			if config['header']:
+				self.response.headers['X-Timing'] = recorder.as_header()
+			instrument.end()
+			if config['log']:
+				logging.info("%s %s %s" % (recorder.method,recorder.path,recorder.as_header()))
+	def _dispatch_request(self):
+		"""Dispatch the request, or respond with 429 Too Many Requests before any
+		routing when the client is over its rate limit"""
+		throttle_state = self._get_throttle()
+		if throttle_state and throttle_state[1]:
+			limiter = throttle_state[1]
+			wait = limiter.acquire(self._get_client_key())
+			if wait:
+				self.response.headers['Retry-After'] = "%d" % math.ceil(wait)
+				return self.response_json(HTTPException(HTTPException.STATUS_TOOMANYREQUESTS))
+		return super(RequestHandler,self).dispatch()
+	def _get(self,path):
+		try:
+			self.route_request(RequestHandler.METHOD_GET,path)
+		except HTTPException,e:
+			self.response_json(e)
+		return (self.response.status,list(self.response.headerlist),self.response.body)
+	def _set_error(self,code):
+		"""Clear the response and set the error status, using the reason from
+		HTTPException for codes which webapp2 has no message for, such as 429"""
+		try:
+			self.error(code)
+		except KeyError:
+			self.response.clear()
+			self.response.set_status(code,HTTPException.REASONS.get(code,"Error"))
+	def _format_profile(self,profiler,lines):
+		"""Return cProfile statistics as text, sorted by cumulative time"""
+		import pstats
+		stream = StringIO.StringIO()
+		stats = pstats.Stats(profiler,stream=stream)
+		stats.sort_stats('cumulative').print_stats(lines)
+		return stream.getvalue()
+	def _write_response(self,codec,content_encoding,obj,etag,last_modified):
+		"""Encode and write the response object with the codec and content encoding,
+		where etag is the entity tag of the representation"""
 		if isinstance(obj,HTTPException):
-			self.error(obj.code)
-			self.response.write(simplejson.dumps(obj.as_json()))
-		elif isinstance(obj,(basestring,bool,int,long,list,tuple,dict)):
-			self.response.write(simplejson.dumps(obj))
-		elif isinstance(obj,(models.Model,query.Feed)):
-			self.response.write(simplejson.dumps(obj.as_json()))
+			self._set_error(obj.code)
+			self._write_body((codec.dumps(obj.as_json()) + codec.TERMINATOR,))
+		elif isinstance(obj,query.Feed) and obj.is_streaming() and getattr(codec,"STREAMING",True):
+			# streamed feeds are written before the body hash is known. Codecs which
+			# cannot stream feeds use the buffered response below
+			if self.response_not_modified(etag,last_modified):
+				return
+			self._write_body(itertools.chain(obj.iter_encoded(codec),(codec.TERMINATOR,)),content_encoding)
+		elif isinstance(obj,(basestring,bool,int,long,list,tuple,dict,models.Model,query.Feed)):
+			if isinstance(obj,models.Model):
+				body = codec.encode_model(obj) + codec.TERMINATOR
+			elif isinstance(obj,query.Feed):
+				body = "".join(obj.iter_encoded(codec)) + codec.TERMINATOR
+			else:
+				body = codec.dumps(obj) + codec.TERMINATOR
+			if etag==None and self._is_conditional():
+				# the body differs for each codec, but not for each content encoding
+				etag = hashlib.md5(body).hexdigest()
+				if content_encoding != None:
+					etag = "%s-%s" % (etag,content_encoding)
+			if self.response_not_modified(etag,last_modified):
+				return
+			self._write_body((body,),content_encoding)
 		else:
 			e = HTTPException(code=HTTPException.STATUS_SERVERERROR,reason="Invalid response object: %s" % type(obj).__name__)
 			self.error(e.code)
-			self.response.write(simplejson.dumps(e.as_json()))
-		self.response.write("\n")
+			self._write_body((codec.dumps(e.as_json()) + codec.TERMINATOR,))
+
+	# PUBLIC METHODS
+	@classmethod
+	def prepare_handler(self):
+		"""Create the data store model classes for the models of the handler, which
+		also checks that each model has a data store, so this is done before the
+		first request. Routes and model schemas are compiled with the class"""
+		for model in self._models.itervalues():
+			model._get_model_proxy_factory().get_model_class()
+	def get_api_key(self):
+		"""Return the API key of the client once it has been validated, or None.
+		Clients are rate limited by API key when one is returned, and otherwise
+		by remote address. Subclasses override this to check a key sent with the
+		request, since an unchecked key could be changed on every request"""
+		return None
+	def get_response_etag(self,etag):
+		"""Return the entity tag of the representation negotiated for the request,
+		where etag is the entity tag of the resource, and set the Vary header. This
+		is the entity tag which response_json sends, so handlers can check it with
+		response_not_modified before reading the resource"""
+		codec = self._get_response_codec()
+		return self._suffix_etag(etag,codec,self._get_content_encoding())
+	def response_not_modified(self,etag=None,last_modified=None):
+		"""Set ETag and Last-Modified response headers, where etag is a string and
+		last_modified is a timestamp. Return True and send 304 Not Modified if the
+		client already has this version, in which case no body should be sent"""
+		not_modified = False
+		if last_modified != None and time.time() < int(last_modified) + 1:
+			# dates have a resolution of one second, so the date is not a validator
+			# until the second has passed and no other write can have the same date
+			last_modified = None
+		if not self._is_conditional():
+			pass
+		elif self.request.headers.get('If-None-Match'):
+			not_modified = etag != None and self._matches_etag(etag)
+		elif self.request.headers.get('If-Modified-Since'):
+			not_modified = last_modified != None and self._not_modified_since(last_modified)
+		if not_modified:
+			self.error(HTTPException.STATUS_NOTMODIFIED)
+		if etag != None:
+			self.response.headers['ETag'] = '"%s"' % etag
+		if last_modified != None:
+			self.response.headers['Last-Modified'] = email.utils.formatdate(last_modified,usegmt=True)
+		return not_modified
+	def response_json(self,obj,etag=None,last_modified=None):
+		"""Send response to client, encoded with the codec negotiated from the Accept
+		header (compact JSON by default) and compressed when the client accepts it.
+		GET responses have an ETag, which is a hash of the body unless set by the
+		caller, and are sent as 304 Not Modified when the client has the same version"""
+		codec = self._get_response_codec()
+		content_encoding = self._get_content_encoding()
+		self.response.headers['Content-Type'] = codec.MEDIA_TYPE
+		if etag != None:
+			etag = self._suffix_etag(etag,codec,content_encoding)
+		with instrument.timer("encode"):
+			self._write_response(codec,content_encoding,obj,etag,last_modified)
 	def route_request(self,method,path):
 		"""Call appropriate matched route for web request"""
 		assert isinstance(method,int) or isinstance(method,long),"route_request: Unexpected method"
 		assert isinstance(path,basestring),"route_request: Unexpected path"
-		for route in self._get_routes():
-			assert isinstance(route,tuple) or isinstance(route,list),"route_request: Invalid route"
-			assert len(route) >= 3,"route_request: Invalid route"
-			# skip route if not correct method
-			if route[0] != method: continue
-			# match route to path
-			m = re.match(route[1],path)
-			if not m: continue
-			# get route arguments
-			args = list(m.groups())
-			# where requests are POST or PUT, append the JSON body to the arguments
-			if method in (RequestHandler.METHOD_POST,RequestHandler.METHOD_PUT):
-				args.append(self._decode_request())
-			# call routing method
-			return route[2](self,*args)
-		raise HTTPException(HTTPException.STATUS_NOTFOUND,reason="Not found, unknown path: %s" % path)
+		with instrument.timer("route"):
+			route = self._route_table and self._route_table.match(method,path)
+		if not route:
+			raise HTTPException(HTTPException.STATUS_NOTFOUND,reason="Not found, unknown path: %s" % path)
+		# get route arguments
+		(func,args) = route
+		args = list(args)
+		# where requests are POST or PUT, append the JSON body to the arguments,
+		# unless the routing method reads the body itself
+		if method in (RequestHandler.METHOD_POST,RequestHandler.METHOD_PUT) and not getattr(func,'raw_body',False):
+			args.append(self._decode_request())
+		# call routing method
+		return func(self,*args)
+
+	# BATCH METHODS
+	def batch_get(self,model_name):
+		"""Respond with objects for the 'key' parameters, with null for missing objects"""
+		model = self._get_model(model_name)
+		keys = self._decode_keys(self.request.get_all('key'))
+		return self.response_json([ entry.as_json() if entry else None for entry in model.get_by_keys(keys) ])
+	def batch_create(self,*args):
+		"""Store the list of objects in the request body, and respond with the stored objects"""
+		entries = args[-1] if len(args) else None
+		if not isinstance(entries,list) or len(entries)==0:
+			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request, expecting list of objects")
+		# group objects by model, so each model is stored with one batch call
+		batches = { }
+		for entry in entries:
+			if not isinstance(entry,models.Model):
+				raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request, expecting list of objects")
+			batches.setdefault(type(entry),[ ]).append(entry)
+		for (model,objects) in batches.iteritems():
+			model.put_multi(objects)
+		return self.response_json([ entry.as_json() for entry in entries ])
+	def batch_delete(self,model_name,keys):
+		"""Delete objects for the list of keys in the request body"""
+		model = self._get_model(model_name)
+		if not isinstance(keys,list):
+			raise HTTPException(HTTPException.STATUS_BADREQUEST,"Bad request, expecting list of keys")
+		keys = self._decode_keys(keys)
+		entries = model.get_by_keys(keys)
+		missing = [ str(key) for (key,entry) in zip(keys,entries) if entry==None ]
+		if len(missing):
+			raise HTTPException(HTTPException.STATUS_NOTFOUND,"No %s entity with keys %s" % (model_name,", ".join(missing)))
+		model.delete_multi(entries)
+		return self.response_json(True)
+	@raw_body
+	def bulk_import(self,model_name):
+		"""Store objects from a request body of newline-delimited JSON, which is read
+		and stored in batches. Objects with a _key update the stored object with
+		that key, so that an export can be imported again, and other objects are
+		created. Lines which are not valid objects, have unknown properties or
+		the key of an object which is not stored are skipped, and the response
+		has the number of objects stored and the errors by line number"""
+		model = self._get_model(model_name)
+		kind = model.get_kind()
+		properties = model._get_properties()
+		created = [ ]
+		updates = [ ]
+		imported = 0
+		errors = [ ]
+		error_count = 0
+		line_number = 0
+		for line in self._iter_body_lines():
+			line_number += 1
+			if not line.strip():
+				continue
+			try:
+				values = encoding.loads(line)
+				if not isinstance(values,dict):
+					raise ValueError("expecting object")
+				if values.get('_type',kind) != kind:
+					raise ValueError("expecting %s" % kind)
+				invalid_keys = [ name for name in values if name not in properties and name not in ('_type','_key') ]
+				if len(invalid_keys):
+					raise ValueError("unknown properties: %s" % ", ".join(sorted(invalid_keys)))
+				key = values.pop('_key',None)
+				values.pop('_type',None)
+				if key==None:
+					created.append((model)(**values))
+				elif isinstance(key,(int,long)) and not isinstance(key,bool) and key > 0:
+					updates.append((line_number,key,values))
+				else:
+					raise ValueError("invalid key")
+			except (TypeError,ValueError), e:
+				error_count += 1
+				if len(errors) < self.IMPORT_MAX_ERRORS:
+					errors.append({ 'line': line_number, 'reason': "%s" % e })
+				continue
+			if len(created) + len(updates) >= self.IMPORT_BATCH_SIZE:
+				(stored,missing) = self._store_import(model,created,updates)
+				imported += stored
+				error_count += len(missing)
+				errors.extend(missing[:max(0,self.IMPORT_MAX_ERRORS - len(errors))])
+				created = [ ]
+				updates = [ ]
+		if len(created) + len(updates):
+			(stored,missing) = self._store_import(model,created,updates)
+			imported += stored
+			error_count += len(missing)
+			errors.extend(missing[:max(0,self.IMPORT_MAX_ERRORS - len(errors))])
+		return self.response_json({
+			'_type': kind,
+			'lines': line_number,
+			'imported': imported,
+			'error_count': error_count,
+			'errors': errors
+		})
+	def bulk_export(self,model_name):
+		"""Respond with all objects of a model as newline-delimited JSON, read in
+		pages with the query cursor and written as each page is encoded"""
+		model = self._get_model(model_name)
+		self.response.headers['Content-Type'] = self.NDJSON_MEDIA_TYPE
+		with instrument.timer("encode"):
+			self._write_body(self._iter_export(model),self._get_content_encoding())
+
+	# REQUEST METHODS
+	def dispatch(self):
+		"""Dispatch the request. The time taken by the first request of the instance
+		is recorded by the startup module"""
+		if not startup.is_warm():
+			with startup.first_request(self.request.method,self.request.path):
+				return self._dispatch_instrumented()
+		return self._dispatch_instrumented()
 	def get(self,path):
-		"""GET handler - get data"""
-		try:
-			self.route_request(RequestHandler.METHOD_GET,path)
-		except HTTPException,e:
-			self.response_json(e)
+		"""GET handler - get data. When coalescing is enabled, identical requests
+		made at the same time share one response"""
+		throttle_state = self._get_throttle()
+		if not throttle_state or not throttle_state[2]:
+			self._get(path)
+			return
+		(config,flight) = (throttle_state[0],throttle_state[2])
+		((status,headerlist,body),shared) = flight.do(self._get_coalesce_key(config,path),lambda: self._get(path))
+		if shared:
+			self.response.status = status
+			self.response.headers = list(headerlist)
+			self.response.body = body
 	def post(self,path):
 		"""POST handler - create data"""
 		try:
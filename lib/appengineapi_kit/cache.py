@@ -0,0 +1,197 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import threading, time, collections
+
+class LRUCache(object):
+	"""In-process cache tier with a size bound and time-to-live in seconds"""
+	def __init__(self,max_size=1000,ttl=60):
+		assert max_size > 0,"LRUCache.__init__: Invalid max_size"
+		self._max_size = max_size
+		self._ttl = ttl
+		self._lock = threading.Lock()
+		# values by key as (expires,value), least recently used first
+		self._items = collections.OrderedDict()
+
+	# PUBLIC METHODS
+	def get(self,key):
+		"""Return value for key, or None"""
+		with self._lock:
+			item = self._items.pop(key,None)
+			if item==None:
+				return None
+			if item[0] != None and item[0] < time.time():
+				return None
+			self._items[key] = item
+			return item[1]
+	def set(self,key,value,ttl=None):
+		"""Set value for key, expiring after ttl seconds or the time-to-live of the cache"""
+		ttl = self._ttl if ttl==None else ttl
+		expires = None if ttl==None else time.time() + ttl
+		with self._lock:
+			self._items.pop(key,None)
+			self._items[key] = (expires,value)
+			while len(self._items) > self._max_size:
+				self._items.popitem(last=False)
+	def add(self,key,value):
+		"""Set value for key unless it already has one, and return True if it was set"""
+		expires = None if self._ttl==None else time.time() + self._ttl
+		with self._lock:
+			item = self._items.get(key)
+			if item != None and (item[0]==None or item[0] >= time.time()):
+				return False
+			self._items.pop(key,None)
+			self._items[key] = (expires,value)
+			while len(self._items) > self._max_size:
+				self._items.popitem(last=False)
+			return True
+	def delete(self,key):
+		with self._lock:
+			self._items.pop(key,None)
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
+class MemcacheTier(object):
+	"""Shared cache tier using App Engine memcache, or any client with get, set, add and delete methods"""
+	def __init__(self,client=None,ttl=300,prefix="appengineapi_kit"):
+		self._client = client
+		self._ttl = ttl
+		self._prefix = prefix
+
+	# PRIVATE METHODS
+	def _get_client(self):
+		if self._client==None:
+			from google.appengine.api import memcache
+			self._client = memcache
+		return self._client
+	def _key(self,key):
+		return "%s:%s" % (self._prefix,key)
+
+	# PUBLIC METHODS
+	def get(self,key):
+		return self._get_client().get(self._key(key))
+	def set(self,key,value,ttl=None):
+		self._get_client().set(self._key(key),value,(self._ttl if ttl==None else ttl) or 0)
+	def add(self,key,value):
+		"""Set value for key unless it already has one, and return True if it was set"""
+		return self._get_client().add(self._key(key),value,self._ttl or 0)
+	def delete(self,key):
+		self._get_client().delete(self._key(key))
+
+class EntityCache(object):
+	"""Two tier read-through cache of encoded entities, keyed by kind and primary key
+
+	Writes through Model.put and Model.delete replace the entity in both tiers
+	with a tombstone, which expires after tombstone_ttl seconds. Reads fill the
+	cache only where it has no value, so a read which started before the write
+	cannot fill the cache with the old entity while the tombstone is present.
+	Writes made on other instances only invalidate the shared tier, so the
+	time-to-live of the local tier bounds how long another instance can read a
+	stale entity.
+	The cache also records a version timestamp for each entity, which is updated
+	when the entity is stored and used for conditional requests, and a version
+	for each kind, which is updated when any entity of the kind is stored or
+	deleted. The kind version is kept in the shared tier when there is one, so
+	that it is the same on every instance.
+	"""
+	# CONSTANTS
+	TOMBSTONE = "appengineapi_kit:written"
+
+	def __init__(self,local=None,shared=None,tombstone_ttl=5):
+		assert local or shared,"EntityCache.__init__: Missing cache tier"
+		assert tombstone_ttl > 0,"EntityCache.__init__: Invalid tombstone_ttl"
+		self._local = local
+		self._shared = shared
+		self._tombstone_ttl = tombstone_ttl
+		self._lock = threading.Lock()
+		self._stats = { 'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0 }
+
+	# PRIVATE METHODS
+	def _key(self,kind,key):
+		return "%s:%s" % (kind,key)
+	def _version_key(self,kind,key):
+		return "version:%s:%s" % (kind,key)
+	def _kind_version_key(self,kind):
+		return "version:%s" % kind
+	def _count(self,name):
+		with self._lock:
+			self._stats[name] += 1
+	def _set_tombstone(self,cache_key):
+		"""Replace cached entity with a tombstone, which stops reads filling the cache"""
+		if self._local:
+			self._local.set(cache_key,EntityCache.TOMBSTONE,self._tombstone_ttl)
+		if self._shared:
+			self._shared.set(cache_key,EntityCache.TOMBSTONE,self._tombstone_ttl)
+
+	# PUBLIC METHODS
+	def get(self,kind,key):
+		"""Return encoded entity, or None"""
+		cache_key = self._key(kind,key)
+		if self._local:
+			value = self._local.get(cache_key)
+			if value != None and value != EntityCache.TOMBSTONE:
+				self._count('local_hits')
+				return value
+		if self._shared:
+			value = self._shared.get(cache_key)
+			if value != None and value != EntityCache.TOMBSTONE:
+				self._count('shared_hits')
+				if self._local:
+					self._local.add(cache_key,value)
+				return value
+		self._count('misses')
+		return None
+	def set(self,kind,key,value):
+		"""Fill the cache with an encoded entity read from the data store, unless
+		the entity is cached or has been written since the tombstone was set"""
+		cache_key = self._key(kind,key)
+		if self._local:
+			self._local.add(cache_key,value)
+		if self._shared:
+			self._shared.add(cache_key,value)
+	def invalidate(self,kind,key):
+		"""Remove cached entity and version"""
+		self._set_tombstone(self._key(kind,key))
+		version_key = self._version_key(kind,key)
+		if self._local:
+			self._local.delete(version_key)
+		if self._shared:
+			self._shared.delete(version_key)
+		self._count('invalidations')
+	def written(self,kind,key,version):
+		"""Remove cached entity after it has been stored, and record the new version"""
+		self._set_tombstone(self._key(kind,key))
+		self._count('invalidations')
+		self.set_version(kind,key,version)
+	def get_version(self,kind,key):
+		"""Return version of entity, or None"""
+		version_key = self._version_key(kind,key)
+		version = self._local.get(version_key) if self._local else None
+		if version==None and self._shared:
+			version = self._shared.get(version_key)
+			if version != None and self._local:
+				self._local.set(version_key,version)
+		return version
+	def set_version(self,kind,key,version):
+		version_key = self._version_key(kind,key)
+		if self._local:
+			self._local.set(version_key,version)
+		if self._shared:
+			self._shared.set(version_key,version)
+	def get_kind_version(self,kind):
+		"""Return version of the entities of a kind, or None"""
+		return (self._shared or self._local).get(self._kind_version_key(kind))
+	def set_kind_version(self,kind,version):
+		(self._shared or self._local).set(self._kind_version_key(kind),version)
+	def get_stats(self):
+		"""Return dictionary of hit, miss and invalidation counters"""
+		with self._lock:
+			return dict(self._stats)
+	def reset_stats(self):
+		with self._lock:
+			for name in self._stats:
+				self._stats[name] = 0
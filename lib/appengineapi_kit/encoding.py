@@ -0,0 +1,201 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import zlib
+
+# choose the fastest JSON implementation available when the module is
+# imported: simplejson with C speedups (when installed in lib3), the
+# standard library json module, or the version bundled with django
+try:
+	import simplejson as json_backend
+except ImportError:
+	try:
+		import json as json_backend
+	except ImportError:
+		from django.utils import simplejson as json_backend
+
+# the binary codec is available when msgpack is installed in lib3
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# CONSTANTS
+SEPARATORS = (',',':')
+CONTENT_ENCODINGS = ('gzip','deflate')
+COMPRESSION_LEVEL = 6
+
+# PRIVATE METHODS
+
+def _quality(params):
+	"""Return the q parameter value from a list of header parameters, defaulting to 1.0"""
+	for param in params:
+		param = param.strip()
+		if param.startswith("q="):
+			try:
+				return float(param[2:])
+			except ValueError:
+				return 0.0
+	return 1.0
+
+def _text(obj):
+	"""Return obj with byte strings, including those in lists and dictionaries,
+	converted to unicode so that msgpack packs them as str rather than bin.
+	Byte strings which are not valid UTF-8 are left as bin"""
+	if isinstance(obj,str):
+		try:
+			return obj.decode("utf-8")
+		except UnicodeDecodeError:
+			return obj
+	if isinstance(obj,dict):
+		return dict([ (_text(key),_text(value)) for (key,value) in obj.iteritems() ])
+	if isinstance(obj,(list,tuple)):
+		return [ _text(value) for value in obj ]
+	return obj
+
+# JSON
+
+def dumps(obj):
+	"""Return compact JSON string for obj"""
+	return json_backend.dumps(obj,separators=SEPARATORS)
+
+def loads(value):
+	"""Return Python object for JSON string, or raise ValueError"""
+	return json_backend.loads(value)
+
+# CODECS
+
+class JSONCodec(object):
+	"""Codec for JSON request and response bodies, which is the default"""
+
+	# CONSTANTS
+	NAME = "json"
+	MEDIA_TYPE = "application/json"
+	TERMINATOR = "\n"
+	# feeds are written as their items are read
+	STREAMING = True
+
+	# PUBLIC METHODS
+	def dumps(self,obj):
+		return dumps(obj)
+	def loads(self,value):
+		return loads(value)
+	def encode_model(self,model):
+		"""Return encoded model object"""
+		return dumps(model.as_json())
+	def iter_feed(self,feed):
+		"""Return generator of encoded chunks for a feed, reading items as they are encoded"""
+		return feed.iter_json(dumps)
+
+class MsgpackCodec(object):
+	"""Codec for MessagePack request and response bodies"""
+
+	# CONSTANTS
+	NAME = "msgpack"
+	MEDIA_TYPE = "application/x-msgpack"
+	TERMINATOR = ""
+	# arrays start with their length, so all the items of a feed are read and
+	# encoded before it is written, and responses do not stream feeds
+	STREAMING = False
+
+	def __init__(self):
+		assert msgpack,"MsgpackCodec.__init__: Missing msgpack module"
+
+	# PUBLIC METHODS
+	def dumps(self,obj):
+		return msgpack.packb(_text(obj),use_bin_type=True)
+	def loads(self,value):
+		"""Return Python object for MessagePack data, or raise ValueError"""
+		try:
+			return msgpack.unpackb(value,raw=False)
+		except Exception:
+			raise ValueError("Invalid msgpack data")
+	def encode_model(self,model):
+		"""Return encoded model object, packing values without building a dictionary"""
+		items = model.as_json_items()
+		packer = msgpack.Packer(use_bin_type=True)
+		return packer.pack_map_header(len(items)) + "".join([ packer.pack(_text(name)) + packer.pack(_text(value)) for (name,value) in items ])
+	def iter_feed(self,feed):
+		"""Return generator of encoded chunks for a feed. The length of the items
+		array comes first, so all items are read and encoded before any chunks
+		are returned"""
+		packer = msgpack.Packer(use_bin_type=True)
+		items = [ self.encode_model(item) for item in feed ]
+		yield packer.pack_map_header(5 if feed.total==None else 6)
+		yield packer.pack(u"_type") + packer.pack(_text(feed.get_model().get_kind()))
+		yield packer.pack(u"limit") + packer.pack(feed.get_limit())
+		yield packer.pack(u"items") + packer.pack_array_header(len(items))
+		for item in items:
+			yield item
+		yield packer.pack(u"count") + packer.pack(len(items))
+		yield packer.pack(u"cursor") + packer.pack(_text(feed.cursor))
+		if feed.total != None:
+			yield packer.pack(u"total") + packer.pack(feed.total)
+
+# registered codecs by media type, and the default codec
+codecs_by_media_type = { }
+default_codec = JSONCodec()
+
+def register_codec(codec):
+	"""Register a codec for request and response bodies of its media type"""
+	assert isinstance(codec.MEDIA_TYPE,basestring),"register_codec: Invalid codec"
+	codecs_by_media_type[codec.MEDIA_TYPE] = codec
+
+def get_request_codec(content_type):
+	"""Return codec for the value of a Content-Type header, or the default codec"""
+	if not content_type:
+		return default_codec
+	return codecs_by_media_type.get(content_type.split(";")[0].strip().lower(),default_codec)
+
+def negotiate_codec(accept):
+	"""Return codec preferred by the value of an Accept header, or the default codec"""
+	if not accept:
+		return default_codec
+	best = None
+	for value in accept.split(","):
+		parts = value.strip().split(";")
+		codec = codecs_by_media_type.get(parts[0].strip().lower())
+		if codec==None:
+			continue
+		quality = _quality(parts[1:])
+		if quality > 0.0 and (best==None or quality > best[1]):
+			best = (codec,quality)
+	return best[0] if best else default_codec
+
+register_codec(default_codec)
+if msgpack:
+	register_codec(MsgpackCodec())
+
+# COMPRESSION
+
+def negotiate_encoding(accept_encoding):
+	"""Return 'gzip', 'deflate' or None for the value of an Accept-Encoding header"""
+	if not accept_encoding:
+		return None
+	accepted = { }
+	for value in accept_encoding.split(","):
+		parts = value.strip().split(";")
+		accepted[parts[0].strip().lower()] = _quality(parts[1:])
+	best = None
+	for name in CONTENT_ENCODINGS:
+		quality = accepted.get(name,accepted.get("*",0.0))
+		if quality > 0.0 and (best==None or quality > best[1]):
+			best = (name,quality)
+	return best[0] if best else None
+
+class Compressor(object):
+	"""Incremental compressor for a gzip or deflate content encoding"""
+	def __init__(self,content_encoding):
+		assert content_encoding in CONTENT_ENCODINGS,"Compressor.__init__: Invalid content encoding"
+		if content_encoding=='gzip':
+			wbits = 16 + zlib.MAX_WBITS
+		else:
+			wbits = zlib.MAX_WBITS
+		self._compressobj = zlib.compressobj(COMPRESSION_LEVEL,zlib.DEFLATED,wbits)
+	def compress(self,data):
+		return self._compressobj.compress(data)
+	def flush(self):
+		return self._compressobj.flush()
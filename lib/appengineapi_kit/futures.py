@@ -0,0 +1,121 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, threading, collections
+
+# CONSTANTS
+DEFAULT_MAX_WORKERS = 10
+
+class Future(object):
+	"""Result of an asynchronous call. The wait function is called once, in the
+	thread which first asks for the result, and returns the result or raises"""
+	def __init__(self,wait):
+		assert callable(wait),"Future.__init__: Invalid wait function"
+		self._wait = wait
+		self._lock = threading.Lock()
+		self._done = False
+		self._result = None
+		self._exc_info = None
+	@classmethod
+	def from_result(self,result):
+		"""Return future which already has a result"""
+		future = (self)(lambda: result)
+		future.get_result()
+		return future
+
+	# PUBLIC METHODS
+	def done(self):
+		return self._done
+	def get_result(self):
+		"""Wait for the call to complete, and return the result or raise its exception"""
+		with self._lock:
+			if not self._done:
+				try:
+					self._result = self._wait()
+				except Exception:
+					self._exc_info = sys.exc_info()
+				self._done = True
+				self._wait = None
+		if self._exc_info:
+			raise self._exc_info[0],self._exc_info[1],self._exc_info[2]
+		return self._result
+	def then(self,func):
+		"""Return future for func called with the result of this future"""
+		return Future(lambda: func(self.get_result()))
+
+class WorkerPool(object):
+	"""Runs calls in at most max_workers threads at a time, queueing the rest.
+	Threads are started when calls are queued and end when the queue is empty,
+	so none are left running once the calls have completed"""
+	def __init__(self,max_workers=DEFAULT_MAX_WORKERS):
+		assert max_workers > 0,"WorkerPool.__init__: Invalid max_workers"
+		self._max_workers = max_workers
+		self._lock = threading.Lock()
+		self._queue = collections.deque()
+		self._workers = 0
+
+	# PRIVATE METHODS
+	def _work(self):
+		while True:
+			with self._lock:
+				if not len(self._queue):
+					self._workers -= 1
+					return
+				call = self._queue.popleft()
+			call()
+
+	# PUBLIC METHODS
+	def run_async(self,func,*args,**kwargs):
+		"""Queue a call of func, and return a future for the result"""
+		outcome = { }
+		done = threading.Event()
+		def call():
+			try:
+				outcome['result'] = func(*args,**kwargs)
+			except Exception:
+				outcome['exc_info'] = sys.exc_info()
+			done.set()
+		with self._lock:
+			self._queue.append(call)
+			start = self._workers < self._max_workers
+			if start:
+				self._workers += 1
+		if start:
+			threading.Thread(target=self._work).start()
+		def wait():
+			done.wait()
+			if 'exc_info' in outcome:
+				exc_info = outcome['exc_info']
+				raise exc_info[0],exc_info[1],exc_info[2]
+			return outcome['result']
+		return Future(wait)
+	def get_workers(self):
+		"""Return number of threads running calls"""
+		with self._lock:
+			return self._workers
+
+# worker pool for calls which are not made through a data store
+default_pool = WorkerPool()
+
+def run_async(func,*args,**kwargs):
+	"""Call func in a thread of the default worker pool, and return a future for the result"""
+	return default_pool.run_async(func,*args,**kwargs)
+
+def wait_all(futures):
+	"""Wait for all futures, and return the list of results. The calls run
+	concurrently, so this takes as long as the slowest call. The exception
+	of the first future which failed is raised once all have completed"""
+	exc_info = None
+	results = [ ]
+	for future in futures:
+		try:
+			results.append(future.get_result())
+		except Exception:
+			exc_info = exc_info or sys.exc_info()
+			results.append(None)
+	if exc_info:
+		raise exc_info[0],exc_info[1],exc_info[2]
+	return results
@@ -4,27 +4,79 @@
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
 # Python imports
-import logging
+import logging, threading, itertools, random
 
 # GAE imports
 from google.appengine.ext import db
+from google.appengine.datastore import entity_pb
 
 # appengineapi_kit imports
-from appengineapi_kit import api,query,models
+from appengineapi_kit import api,query,models,instrument,futures
 
 class Select(query.Select):
 	"""Implements specific methods for the query/select for App Engine datastore"""
-	def run(self,limit):
-		# obtain an empty feed object
-		feed = super(Select,self).run(limit)
-		# get query object
-		query = self._model.proxy.get_model_class().gql("")
-		# iterate over returned items
-		for item in query.run(limit=limit):
-			entity = (self._model)(_proxy=item)
-			feed.append(entity)
-		# return feed
-		return feed
+	def __init__(self,model,**kwargs):
+		super(Select,self).__init__(model,**kwargs)
+		self._datastore_query = None
+	def end_cursor(self,entity):
+		return self._datastore_query.cursor()
+	def iterate(self,limit=None):
+		# the query starts when it is run, and results are fetched in batches as they are read
+		self._datastore_query = self._get_paged_query()
+		return self._iterate(self._datastore_query.run(limit=limit))
+	def iterate_keys(self,limit=None):
+		# keys-only queries return keys without reading the entities
+		self._datastore_query = self._get_paged_query(keys_only=True)
+		return self._iterate_keys(self._datastore_query.run(limit=limit))
+	def run_async(self,limit=None):
+		# the query runs in the background until the feed is read from the future
+		instrument.count_rpc("query")
+		source = self._source(limit)
+		return futures.Future(lambda: self._read_feed(source,limit))
+	def count(self):
+		# use the sharded counter when there are no filters, or count with a keys-only query
+		datastore = self._model._get_model_proxy_factory()
+		if not self.get_filters():
+			count = datastore.get_count()
+			if count != None:
+				return count
+		return self._get_datastore_query(keys_only=True,ordered=False).count(limit=None)
+	def _get_paged_query(self,keys_only=False):
+		"""Return GQL query starting from the cursor"""
+		datastore_query = self._get_datastore_query(keys_only=keys_only)
+		if self._cursor:
+			try:
+				datastore_query.with_cursor(self._cursor)
+			except (db.BadValueError,db.BadRequestError):
+				raise ValueError("Invalid cursor")
+		return datastore_query
+	def _get_datastore_query(self,keys_only=False,ordered=True):
+		"""Return GQL query for the filters, orders and projection, or a keys-only
+		query. Projected properties need to be indexed, and cannot also be used
+		in equality filters"""
+		conditions = [ ]
+		arguments = [ ]
+		for (name,operator,value) in self.get_filters():
+			arguments.append(list(value) if operator=="IN" else value)
+			conditions.append("%s %s :%d" % (name,operator,len(arguments)))
+		clauses = ""
+		if len(conditions):
+			clauses += " WHERE %s" % " AND ".join(conditions)
+		if ordered and len(self.get_orders()):
+			clauses += " ORDER BY %s" % ", ".join([ (name + " DESC") if descending else name for (name,descending) in self.get_orders() ])
+		model_class = self._model._get_model_proxy_factory().get_model_class()
+		if keys_only:
+			return db.GqlQuery("SELECT __key__ FROM %s%s" % (model_class.kind(),clauses),*arguments)
+		fields = self.get_fields()
+		if fields==None:
+			return model_class.gql(clauses,*arguments)
+		return db.GqlQuery("SELECT %s FROM %s%s" % (", ".join(fields),model_class.kind(),clauses),*arguments)
+	def _iterate(self,items):
+		for item in items:
+			yield self._model._from_proxy(item,self._fields)
+	def _iterate_keys(self,keys):
+		for key in keys:
+			yield models.KeyRef(self._model,key.id())
 
 class DataModel(db.Expando,models.AbstractDataModel):
 	""""Implements the Google App Engine datastore model object"""
@@ -38,7 +90,8 @@ class DataModel(db.Expando,models.AbstractDataModel):
 		assert (isinstance(key,int) or isinstance(key,long)),"DatastoreModel.get_by_primary_key: Invalid key type"
 		assert key > 0,"DatastoreModel.get_by_primary_key: Invalid key value"
 		return self.get_by_id(key)
-	def put(self):
+	def put(self,fields=None):
+		# entities are always written whole
 		return super(db.Expando,self).put()
 	def delete(self):
 		assert self.is_saved()==True,"DatastoreModel.update: Calling update on new object"
@@ -46,13 +99,109 @@ class DataModel(db.Expando,models.AbstractDataModel):
 	def primary_key(self):
 		return super(db.Expando,self).key().id()
 
+class CountShard(db.Model):
+	"""Shard of the counter of stored entities for a kind, with key name kind:shard"""
+	count = db.IntegerProperty(default=0,indexed=False)
+	@classmethod
+	def kind(self):
+		return "appengineapi_kit_count"
+
 class DataStore(models.AbstractDataStore):
-	""""Factory class which generates Google App Engine datastore model objects"""
+	""""Factory class which generates Google App Engine datastore model objects.
+	When count_shards is set, the number of entities is kept in a sharded
+	counter, which is updated when new objects are stored or deleted through
+	the Model class. Call rebuild_count to start counting existing entities"""
+
+	# CONSTANTS
+	MAX_BATCH_SIZE = 500
+
+	# registry of generated model classes, keyed by entity name and shared
+	# between all DataStore instances
+	_model_classes = { }
+	_model_classes_lock = threading.Lock()
+
+	def __init__(self,entity_name,count_shards=None):
+		models.AbstractDataStore.__init__(self,entity_name)
+		assert count_shards==None or count_shards > 0,"DataStore.__init__: Invalid count_shards"
+		self._count_shards = count_shards
+
 	def get_model_class(self):
-		# return a new model object
+		# return the model class for the entity, creating it on first use
 		entity_name = self.get_entity_name()
-		model_class = type(entity_name,(DataModel,),{ })
+		model_class = DataStore._model_classes.get(entity_name)
+		if model_class==None:
+			with DataStore._model_classes_lock:
+				model_class = DataStore._model_classes.get(entity_name)
+				if model_class==None:
+					model_class = type(entity_name,(DataModel,),{ })
+					DataStore._model_classes[entity_name] = model_class
 		return model_class
 	def get_select(self,model,**kwargs):
 		return Select(model,**kwargs)
+	def get_multi(self,keys):
+		for key in keys:
+			assert (isinstance(key,int) or isinstance(key,long)) and key > 0,"DataStore.get_multi: Invalid key"
+		kind = self.get_model_class().kind()
+		proxies = [ ]
+		for batch in self._batches(keys):
+			proxies.extend(db.get([ db.Key.from_path(kind,key) for key in batch ]))
+		return proxies
+	def put_multi(self,proxies,fields=None):
+		# entities are always written whole, so changed fields are not used
+		keys = [ ]
+		for batch in self._batches(proxies):
+			keys.extend(db.put(batch))
+		return keys
+	def delete_multi(self,proxies):
+		for proxy in proxies:
+			assert proxy.is_saved()==True,"DataStore.delete_multi: Calling delete on new object"
+		for batch in self._batches(proxies):
+			db.delete(batch)
+	def get_multi_async(self,keys):
+		# start one datastore RPC for each batch, which run concurrently
+		for key in keys:
+			assert (isinstance(key,int) or isinstance(key,long)) and key > 0,"DataStore.get_multi_async: Invalid key"
+		kind = self.get_model_class().kind()
+		rpcs = [ db.get_async([ db.Key.from_path(kind,key) for key in batch ]) for batch in self._batches(keys) ]
+		return futures.Future(lambda: list(itertools.chain.from_iterable([ rpc.get_result() for rpc in rpcs ])))
+	def put_multi_async(self,proxies,fields=None):
+		rpcs = [ db.put_async(batch) for batch in self._batches(proxies) ]
+		return futures.Future(lambda: list(itertools.chain.from_iterable([ rpc.get_result() for rpc in rpcs ])))
+	def update_count(self,delta):
+		if not self._count_shards or delta==0:
+			return
+		# increment a random shard, so that concurrent updates rarely contend
+		key_name = self._count_key_name(random.randint(0,self._count_shards - 1))
+		def increment():
+			shard = CountShard.get_by_key_name(key_name)
+			if shard==None:
+				shard = CountShard(key_name=key_name)
+			shard.count += delta
+			shard.put()
+		db.run_in_transaction(increment)
+	def get_count(self):
+		if not self._count_shards:
+			return None
+		keys = [ db.Key.from_path(CountShard.kind(),self._count_key_name(shard)) for shard in xrange(self._count_shards) ]
+		return sum([ shard.count for shard in db.get(keys) if shard ])
+	def rebuild_count(self):
+		"""Set the sharded counter to the number of stored entities, counted with a keys-only query"""
+		assert self._count_shards,"DataStore.rebuild_count: Entities are not counted"
+		count = db.GqlQuery("SELECT __key__ FROM %s" % self.get_model_class().kind()).count(limit=None)
+		shards = [ CountShard(key_name=self._count_key_name(shard),count=0) for shard in xrange(self._count_shards) ]
+		shards[0].count = count
+		db.put(shards)
+		return count
+	def encode_proxy(self,proxy):
+		return db.model_to_protobuf(proxy).Encode()
+	def decode_proxy(self,value):
+		return db.model_from_protobuf(entity_pb.EntityProto(value))
+
+	# PRIVATE METHODS
+	def _count_key_name(self,shard):
+		return "%s:%d" % (self.get_entity_name(),shard)
+	def _batches(self,items):
+		"""Split items into lists no larger than the datastore batch size"""
+		for i in xrange(0,len(items),DataStore.MAX_BATCH_SIZE):
+			yield items[i:i + DataStore.MAX_BATCH_SIZE]
 
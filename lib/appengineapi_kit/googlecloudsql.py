@@ -3,11 +3,15 @@
 
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
-# GAE imports
-from google.appengine.ext import db, rdbms
+# Python imports
+import sys, threading, time, logging, contextlib, collections
 
 # appengineapi_kit imports
-from appengineapi_kit import api
+from appengineapi_kit import api,query,models,futures
+
+class PoolError(Exception):
+	""" Connection pool error, for example when no connection becomes available """
+	pass
 
 class Connection:
 	"""Class to connect to remote RDBMS"""
@@ -21,25 +25,462 @@ class Connection:
 		if password:
 			self._params['password'] = password
 		self._handle = None
+	def open(self):
+		"""Return a new DB-API connection, which can be used as a ConnectionPool factory"""
+		from google.appengine.api import rdbms
+		return rdbms.connect(**self._params)
 	def connect(self,force_disconnect=False):
 		if self._handle != None and force_disconnect:
 			self.disconnect()
 			assert self._handle==None
-		params = self._params
 		if self._handle==None:
-			self._handle = rdbms.connect(**params)
+			self._handle = self.open()
 	def disconnect(self):
 		if self._handle:
 			self._handle.close()
 			self._handle = None
 
-class DataModel(api.AbstractDataModel):
-	pass
+class PooledConnection(object):
+	"""DB-API connection checked out of a ConnectionPool, with a cache of statement cursors"""
+	def __init__(self,handle,statement_cache_size=20):
+		self._handle = handle
+		self._statement_cache_size = statement_cache_size
+		# cursors by SQL statement, least recently used first, as [cursor,busy] pairs
+		self._statements = collections.OrderedDict()
+		self.created = self.last_used = self.last_checked = time.time()
+
+	# PUBLIC METHODS
+	@contextlib.contextmanager
+	def statement(self,sql):
+		"""Context manager returning a cursor for executing sql, reused between calls with the same sql"""
+		entry = self._statements.pop(sql,None)
+		if entry==None:
+			entry = [ self._handle.cursor(),False ]
+		self._statements[sql] = entry
+		if entry[1]:
+			# the cached cursor is still in use, so use a temporary one
+			cursor = self._handle.cursor()
+			try:
+				yield cursor
+			finally:
+				cursor.close()
+			return
+		entry[1] = True
+		self._evict_statements()
+		try:
+			yield entry[0]
+		finally:
+			entry[1] = False
+	def execute(self,sql,bindings=( )):
+		"""Execute statement and return all rows"""
+		with self.statement(sql) as cursor:
+			cursor.execute(sql,tuple(bindings))
+			if cursor.description==None:
+				return [ ]
+			return cursor.fetchall()
+	def is_alive(self):
+		"""Return True if the connection responds to a simple query"""
+		try:
+			cursor = self._handle.cursor()
+			try:
+				cursor.execute("SELECT 1")
+				cursor.fetchall()
+			finally:
+				cursor.close()
+			self.last_checked = time.time()
+			return True
+		except Exception, e:
+			logging.warning("PooledConnection.is_alive: %s" % e)
+			return False
+	def commit(self):
+		self._handle.commit()
+	def rollback(self):
+		self._handle.rollback()
+	def close(self):
+		for (cursor,busy) in self._statements.itervalues():
+			try:
+				cursor.close()
+			except Exception:
+				pass
+		self._statements.clear()
+		try:
+			self._handle.close()
+		except Exception, e:
+			logging.warning("PooledConnection.close: %s" % e)
+
+	# PRIVATE METHODS
+	def _evict_statements(self):
+		"""Close least recently used cursors which are not in use"""
+		for sql in self._statements.keys():
+			if len(self._statements) <= self._statement_cache_size:
+				break
+			(cursor,busy) = self._statements[sql]
+			if not busy:
+				del self._statements[sql]
+				cursor.close()
+
+class ConnectionPool(object):
+	"""Thread-safe pool of DB-API connections
+
+	The factory is a callable returning a new DB-API connection, for example
+	Connection(instance,database).open for Cloud SQL, or for local testing:
+
+		ConnectionPool(lambda: sqlite3.connect(path),paramstyle="qmark",lastrowid_first=False)
+
+	Rows are inserted in batches, and lastrowid_first is True when the lastrowid
+	of a cursor after a multi-row INSERT is the key of the first row, as for
+	MySQL, or False when it is the key of the last row, as for SQLite. The keys
+	of the rows inserted by one statement need to be consecutive, which for
+	MySQL requires an innodb_autoinc_lock_mode of 0 or 1.
+	"""
+
+	# CONSTANTS
+	PLACEHOLDERS = { 'format': "%s", 'qmark': "?" }
+
+	def __init__(self,factory,max_size=5,max_idle=300,check_interval=30,timeout=10,statement_cache_size=20,paramstyle="format",lastrowid_first=True):
+		assert callable(factory),"ConnectionPool.__init__: Invalid factory"
+		assert max_size > 0,"ConnectionPool.__init__: Invalid max_size"
+		assert paramstyle in ConnectionPool.PLACEHOLDERS,"ConnectionPool.__init__: Unsupported paramstyle"
+		self._factory = factory
+		self._max_size = max_size
+		self._max_idle = max_idle
+		self._check_interval = check_interval
+		self._timeout = timeout
+		self._statement_cache_size = statement_cache_size
+		self._paramstyle = paramstyle
+		self._lastrowid_first = lastrowid_first
+		# idle connections, most recently used last, and number of open connections
+		self._condition = threading.Condition()
+		self._idle = [ ]
+		self._size = 0
+		# connection checked out by each thread
+		self._local = threading.local()
+		# asynchronous calls each use a connection, leaving one for the thread
+		# handling the request, so that they do not wait for one another
+		self._worker_pool = futures.WorkerPool(max(1,max_size - 1))
+
+	# PROPERTIES
+	def get_placeholder(self):
+		"""Return the parameter placeholder for SQL statements"""
+		return ConnectionPool.PLACEHOLDERS[self._paramstyle]
+	placeholder = property(get_placeholder)
+	def get_size(self):
+		return self._size
+	size = property(get_size)
+	def get_worker_pool(self):
+		"""Return worker pool for asynchronous calls which use the connections"""
+		return self._worker_pool
+	worker_pool = property(get_worker_pool)
+	def get_lastrowid_first(self):
+		"""Return True if lastrowid is the key of the first row of a multi-row INSERT"""
+		return self._lastrowid_first
+	lastrowid_first = property(get_lastrowid_first)
+
+	# PRIVATE METHODS
+	def _evict_idle(self):
+		"""Remove connections which have been idle for too long, return them for closing"""
+		expired = [ ]
+		if self._max_idle != None:
+			now = time.time()
+			for conn in list(self._idle):
+				if now - conn.last_used > self._max_idle:
+					self._idle.remove(conn)
+					self._size -= 1
+					expired.append(conn)
+		return expired
+	def _discard(self,conn):
+		conn.close()
+		with self._condition:
+			self._size -= 1
+			self._condition.notify()
+
+	# PUBLIC METHODS
+	def acquire(self):
+		"""Check out a connection, waiting up to the timeout for one to become free"""
+		deadline = None if self._timeout==None else time.time() + self._timeout
+		while True:
+			conn = None
+			expired = [ ]
+			with self._condition:
+				while True:
+					expired.extend(self._evict_idle())
+					if len(self._idle) or self._size < self._max_size:
+						break
+					remaining = None if deadline==None else deadline - time.time()
+					if remaining != None and remaining <= 0:
+						raise PoolError("ConnectionPool.acquire: No connection available after %ss" % self._timeout)
+					self._condition.wait(remaining)
+				if len(self._idle):
+					conn = self._idle.pop()
+				else:
+					self._size += 1
+			for expired_conn in expired:
+				expired_conn.close()
+			if conn==None:
+				# open a new connection outside the lock
+				try:
+					return PooledConnection(self._factory(),self._statement_cache_size)
+				except:
+					with self._condition:
+						self._size -= 1
+						self._condition.notify()
+					raise
+			# check liveness of connections which have not been used recently
+			if self._check_interval != None and time.time() - max(conn.last_used,conn.last_checked) > self._check_interval and not conn.is_alive():
+				self._discard(conn)
+				continue
+			return conn
+	def release(self,conn):
+		"""Return a connection to the pool"""
+		conn.last_used = time.time()
+		with self._condition:
+			self._idle.append(conn)
+			self._condition.notify()
+	@contextlib.contextmanager
+	def connection(self):
+		"""Context manager which checks out a connection for the current thread, committing
+		on success and rolling back on error. Nested use in the same thread shares the connection.
+		A generator which is closed inside the block commits, as it has not failed"""
+		conn = getattr(self._local,'connection',None)
+		if conn != None:
+			yield conn
+			return
+		conn = self.acquire()
+		self._local.connection = conn
+		reusable = True
+		try:
+			try:
+				yield conn
+				conn.commit()
+			except GeneratorExit:
+				conn.commit()
+				raise
+			except:
+				exc_info = sys.exc_info()
+				try:
+					conn.rollback()
+				except Exception, e:
+					# connection is unusable, so do not return it to the pool
+					logging.warning("ConnectionPool.connection: %s" % e)
+					reusable = False
+				raise exc_info[0],exc_info[1],exc_info[2]
+		finally:
+			self._local.connection = None
+			if reusable:
+				self.release(conn)
+			else:
+				self._discard(conn)
+	def close(self):
+		"""Close idle connections"""
+		with self._condition:
+			idle = self._idle
+			self._idle = [ ]
+			self._size -= len(idle)
+			self._condition.notify_all()
+		for conn in idle:
+			conn.close()
+
+class Select(query.Select):
+	"""Implements specific methods for the query/select for Google Cloud SQL"""
+
+	# CONSTANTS
+	CHUNK_SIZE = 100
+
+	def iterate(self,limit=None):
+		datastore = self._model._get_model_proxy_factory()
+		# compile the statement now, so that an invalid cursor is reported before any rows are read
+		(sql,bindings) = self._compile_sql(limit,datastore.get_pool().placeholder)
+		return self._iterate(datastore,sql,bindings)
+	def iterate_keys(self,limit=None):
+		# select the key and ordered columns, which are needed for the cursor
+		datastore = self._model._get_model_proxy_factory()
+		(sql,bindings) = self._compile_sql(limit,datastore.get_pool().placeholder,keys_only=True)
+		return self._iterate_keys(datastore,sql,bindings)
+	def count(self):
+		datastore = self._model._get_model_proxy_factory()
+		(sql,bindings) = self._compile_count_sql(datastore.get_pool().placeholder)
+		with datastore.get_pool().connection() as conn:
+			return conn.execute(sql,bindings)[0][0]
+	def _iterate_rows(self,datastore,sql,bindings):
+		"""Yield tuple of (names,rows) for each chunk of rows. Rows are read on a
+		connection of their own rather than the connection of the thread, so that
+		writes made while a streamed feed is read are not in its transaction, and
+		the connection is returned to the pool when the reader stops"""
+		pool = datastore.get_pool()
+		conn = pool.acquire()
+		reusable = True
+		try:
+			with conn.statement(sql) as cursor:
+				cursor.execute(sql,tuple(bindings))
+				names = [ str(column[0]) for column in cursor.description ]
+				while True:
+					rows = cursor.fetchmany(Select.CHUNK_SIZE)
+					if not rows:
+						break
+					yield (names,rows)
+		finally:
+			try:
+				# end the read transaction
+				conn.rollback()
+			except Exception, e:
+				logging.warning("Select._iterate_rows: %s" % e)
+				reusable = False
+			if reusable:
+				pool.release(conn)
+			else:
+				pool._discard(conn)
+	def _iterate(self,datastore,sql,bindings):
+		# read rows in chunks, decoding each chunk into model objects
+		model_class = datastore.get_model_class()
+		for (names,rows) in self._iterate_rows(datastore,sql,bindings):
+			for row in rows:
+				yield self._model._from_proxy(model_class.from_row(names,row),self._fields)
+	def _iterate_keys(self,datastore,sql,bindings):
+		for (names,rows) in self._iterate_rows(datastore,sql,bindings):
+			for row in rows:
+				yield models.KeyRef(self._model,row[0],dict(zip(names[1:],row[1:])))
+
+class DataModel(models.AbstractDataModel):
+	""""Implements a Google Cloud SQL table row as a model proxy object"""
+
+	# datastore which generated the model class
+	_datastore = None
+
+	def __init__(self):
+		self._key = None
+		self._values = { }
+	def __setitem__(self,name,value):
+		self._values[name] = value
+	def __getitem__(self,name):
+		return self._values.get(name)
+	@classmethod
+	def from_row(self,names,row):
+		"""Return proxy object from a row, where names are the column names"""
+		proxy = (self)()
+		for (name,value) in zip(names,row):
+			if name==query.Select.KEY_COLUMN:
+				proxy._key = value
+			else:
+				proxy._values[name] = value
+		return proxy
+	@classmethod
+	def get_by_primary_key(self,key):
+		assert (isinstance(key,int) or isinstance(key,long)),"DataModel.get_by_primary_key: Invalid key type"
+		assert key > 0,"DataModel.get_by_primary_key: Invalid key value"
+		return self._datastore.get_multi([ key ])[0]
+	def put(self,fields=None):
+		"""Insert row, or update the columns for fields (all columns when None)"""
+		return self._datastore.put_multi([ self ],[ fields ])[0]
+	def delete(self):
+		assert self.is_saved()==True,"DataModel.delete: Calling delete on new object"
+		self._datastore.delete_multi([ self ])
+	def primary_key(self):
+		return self._key
+	def is_saved(self):
+		return self._key != None
+
+class Datastore(models.AbstractDataStore):
+	""""Factory class which generates Google Cloud SQL model objects, using a ConnectionPool"""
+
+	# CONSTANTS
+	MAX_BATCH_SIZE = 500
+	# bindings in one statement, which is the SQLite limit before version 3.32
+	MAX_BINDINGS = 999
+
+	def __init__(self,entity_name,pool):
+		models.AbstractDataStore.__init__(self,entity_name)
+		assert isinstance(pool,ConnectionPool),"Datastore.__init__: Invalid pool"
+		self._pool = pool
+		self._model_class = type(entity_name,(DataModel,),{ '_datastore': self })
+	def get_pool(self):
+		return self._pool
+	def get_worker_pool(self):
+		return self._pool.worker_pool
+	def get_model_class(self):
+		return self._model_class
+	def get_select(self,model,**kwargs):
+		return Select(model,**kwargs)
+	def get_multi(self,keys):
+		# read rows with one statement per batch of keys
+		proxies = { }
+		with self._pool.connection() as conn:
+			for i in xrange(0,len(keys),Datastore.MAX_BATCH_SIZE):
+				batch = keys[i:i + Datastore.MAX_BATCH_SIZE]
+				sql = "SELECT * FROM %s WHERE %s IN (%s)" % (self.get_entity_name(),query.Select.KEY_COLUMN,", ".join([ self._pool.placeholder ] * len(batch)))
+				with conn.statement(sql) as cursor:
+					cursor.execute(sql,tuple(batch))
+					names = [ str(column[0]) for column in cursor.description ]
+					for row in cursor.fetchall():
+						proxy = self._model_class.from_row(names,row)
+						proxies[proxy.primary_key()] = proxy
+		return [ proxies.get(key) for key in keys ]
+	def put_multi(self,proxies,fields=None):
+		# store all objects in one transaction, with one statement for each batch
+		# of new rows with the same columns, and one statement for each batch of
+		# stored rows with the same changed columns
+		fields = fields or [ None ] * len(proxies)
+		inserts = collections.OrderedDict()
+		updates = collections.OrderedDict()
+		for (proxy,names) in zip(proxies,fields):
+			if proxy._key==None:
+				inserts.setdefault(tuple(sorted(proxy._values.keys())),[ ]).append(proxy)
+			else:
+				names = tuple(sorted(proxy._values.keys() if names==None else names))
+				if len(names):
+					updates.setdefault(names,[ ]).append(proxy)
+		with self._pool.connection() as conn:
+			for (names,group) in inserts.iteritems():
+				for batch in self._batches(group,len(names)):
+					self._insert(conn,names,batch)
+			for (names,group) in updates.iteritems():
+				for batch in self._batches(group,2 * len(names) + 1):
+					self._update(conn,names,batch)
+		return [ proxy._key for proxy in proxies ]
+	def delete_multi(self,proxies):
+		# delete rows with one statement per batch of keys
+		keys = [ proxy.primary_key() for proxy in proxies ]
+		with self._pool.connection() as conn:
+			for i in xrange(0,len(keys),Datastore.MAX_BATCH_SIZE):
+				batch = keys[i:i + Datastore.MAX_BATCH_SIZE]
+				sql = "DELETE FROM %s WHERE %s IN (%s)" % (self.get_entity_name(),query.Select.KEY_COLUMN,", ".join([ self._pool.placeholder ] * len(batch)))
+				conn.execute(sql,batch)
+		for proxy in proxies:
+			proxy._key = None
+	def encode_proxy(self,proxy):
+		return (proxy.primary_key(),dict(proxy._values))
+	def decode_proxy(self,value):
+		proxy = (self._model_class)()
+		proxy._key = value[0]
+		proxy._values = dict(value[1])
+		return proxy
 
-class Datastore(api.AbstractDataStore):
-	""""Factory class which generates Google App Engine datastore model objects"""
-	def get_model_class(self,name):
-		assert isinstance(name,basestring) and len(name),"Datastore.get_model_class: Invalid model class name"
-		# return a new model object
-		model_class = type(name,(DataModel,),{ })
-		return model_class
+	# PRIVATE METHODS
+	def _batches(self,proxies,bindings_per_row):
+		"""Yield lists of proxies for statements with up to MAX_BINDINGS bindings"""
+		size = max(1,min(Datastore.MAX_BATCH_SIZE,Datastore.MAX_BINDINGS // max(1,bindings_per_row)))
+		for i in xrange(0,len(proxies),size):
+			yield proxies[i:i + size]
+	def _insert(self,conn,names,proxies):
+		"""Insert rows with one statement, and set the keys of the proxies"""
+		row = "(%s)" % ", ".join([ self._pool.placeholder ] * len(names))
+		sql = "INSERT INTO %s (%s) VALUES %s" % (self.get_entity_name(),", ".join(names),", ".join([ row ] * len(proxies)))
+		bindings = [ ]
+		for proxy in proxies:
+			bindings.extend([ proxy._values[name] for name in names ])
+		with conn.statement(sql) as cursor:
+			cursor.execute(sql,tuple(bindings))
+			# keys of the rows inserted by one statement are consecutive
+			first_key = cursor.lastrowid if self._pool.lastrowid_first else cursor.lastrowid - len(proxies) + 1
+		for (i,proxy) in enumerate(proxies):
+			proxy._key = first_key + i
+	def _update(self,conn,names,proxies):
+		"""Update columns of rows with one statement, selecting the value for each row by key"""
+		placeholder = self._pool.placeholder
+		case = "CASE %s %s END" % (query.Select.KEY_COLUMN," ".join([ "WHEN %s THEN %s" % (placeholder,placeholder) ] * len(proxies)))
+		sql = "UPDATE %s SET %s WHERE %s IN (%s)" % (self.get_entity_name(),", ".join([ "%s = %s" % (name,case) for name in names ]),query.Select.KEY_COLUMN,", ".join([ placeholder ] * len(proxies)))
+		bindings = [ ]
+		for name in names:
+			for proxy in proxies:
+				bindings.extend((proxy._key,proxy._values.get(name)))
+		bindings.extend([ proxy._key for proxy in proxies ])
+		conn.execute(sql,bindings)
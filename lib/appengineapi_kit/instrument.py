@@ -0,0 +1,159 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import threading, time, logging
+
+# the recorder for the request being handled by the current thread
+_local = threading.local()
+
+# functions called with the recorder when each request finishes
+_hooks = [ ]
+
+class Recorder(object):
+	"""Per-phase timings, RPC counts and payload sizes for one request. Phases
+	can overlap, for example reading from the data store while a streamed feed
+	is encoded"""
+	def __init__(self,method=None,path=None):
+		self.method = method
+		self.path = path
+		self.start = time.time()
+		self.end = None
+		# seconds by phase, RPC counts by operation and bytes by payload
+		self.timings = { }
+		self.rpcs = { }
+		self.sizes = { }
+		# cProfile statistics, when the request was profiled and slow
+		self.profile = None
+
+	# PUBLIC METHODS
+	def add_time(self,phase,elapsed):
+		self.timings[phase] = self.timings.get(phase,0.0) + elapsed
+	def count_rpc(self,name,count=1):
+		self.rpcs[name] = self.rpcs.get(name,0) + count
+	def add_size(self,name,size):
+		self.sizes[name] = self.sizes.get(name,0) + size
+	def finish(self):
+		self.end = time.time()
+	def get_elapsed(self):
+		"""Return seconds since the request started, or the total once finished"""
+		return (self.end or time.time()) - self.start
+	def get_rpc_count(self):
+		return sum(self.rpcs.values())
+	def as_header(self):
+		"""Return value for the X-Timing response header, with times in milliseconds"""
+		values = [ "total=%.1f" % (self.get_elapsed() * 1000.0) ]
+		values.extend([ "%s=%.1f" % (phase,self.timings[phase] * 1000.0) for phase in sorted(self.timings) ])
+		values.append("rpcs=%d" % self.get_rpc_count())
+		values.extend([ "%s_bytes=%d" % (name,self.sizes[name]) for name in sorted(self.sizes) ])
+		return ", ".join(values)
+	def as_json(self):
+		return {
+			'method': self.method,
+			'path': self.path,
+			'elapsed': self.get_elapsed(),
+			'timings': dict(self.timings),
+			'rpcs': dict(self.rpcs),
+			'sizes': dict(self.sizes)
+		}
+
+class Timer(object):
+	"""Context manager which adds the time spent in a block to a phase"""
+	def __init__(self,recorder,phase):
+		self._recorder = recorder
+		self._phase = phase
+	def __enter__(self):
+		self._start = time.time()
+		return self
+	def __exit__(self,exc_type,exc_value,traceback):
+		self._recorder.add_time(self._phase,time.time() - self._start)
+		return False
+
+class NullTimer(object):
+	"""Context manager used when no request is being recorded"""
+	def __enter__(self):
+		return self
+	def __exit__(self,exc_type,exc_value,traceback):
+		return False
+
+_null_timer = NullTimer()
+
+# RECORDING
+
+def begin(method=None,path=None):
+	"""Start recording a request on the current thread, and return the recorder"""
+	recorder = Recorder(method,path)
+	_local.recorder = recorder
+	return recorder
+
+def end():
+	"""Stop recording the request on the current thread, call the hooks and
+	return the recorder, or None if no request was being recorded"""
+	recorder = getattr(_local,'recorder',None)
+	_local.recorder = None
+	if recorder==None:
+		return None
+	recorder.finish()
+	for hook in tuple(_hooks):
+		try:
+			hook(recorder)
+		except Exception, e:
+			logging.exception("instrument: hook %r failed: %s" % (hook,e))
+	return recorder
+
+def current():
+	"""Return recorder for the request on the current thread, or None"""
+	return getattr(_local,'recorder',None)
+
+def timer(phase):
+	"""Return context manager which records the time spent in a phase"""
+	recorder = getattr(_local,'recorder',None)
+	if recorder==None:
+		return _null_timer
+	return Timer(recorder,phase)
+
+def timed(phase,iterable):
+	"""Return iterator over iterable which records the time spent reading each item
+	in a phase, for sources such as streamed queries which are read after the
+	call which creates them has returned"""
+	recorder = getattr(_local,'recorder',None)
+	if recorder==None:
+		return iterable
+	return _timed(recorder,phase,iter(iterable))
+
+def _timed(recorder,phase,iterator):
+	while True:
+		start = time.time()
+		try:
+			item = iterator.next()
+		except StopIteration:
+			recorder.add_time(phase,time.time() - start)
+			return
+		recorder.add_time(phase,time.time() - start)
+		yield item
+
+def count_rpc(name,count=1):
+	"""Count data store calls for an operation"""
+	recorder = getattr(_local,'recorder',None)
+	if recorder != None:
+		recorder.count_rpc(name,count)
+
+def add_size(name,size):
+	"""Add to the size in bytes of a payload"""
+	recorder = getattr(_local,'recorder',None)
+	if recorder != None:
+		recorder.add_size(name,size)
+
+# HOOKS
+
+def add_hook(func):
+	"""Add function which is called with the recorder when each request finishes"""
+	assert callable(func),"add_hook: Invalid hook"
+	if func not in _hooks:
+		_hooks.append(func)
+
+def remove_hook(func):
+	if func in _hooks:
+		_hooks.remove(func)
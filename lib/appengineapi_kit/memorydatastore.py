@@ -0,0 +1,290 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import threading, time, random, bisect, itertools
+
+# appengineapi_kit imports
+from appengineapi_kit import api,query,models
+
+class DatastoreError(Exception):
+	""" Data store call failure, injected by a LatencyProfile """
+	pass
+
+class LatencyProfile(object):
+	"""Latency and failures injected into in-memory data store calls. Values are
+	drawn from a random generator with a fixed seed, so that runs are repeatable"""
+	def __init__(self,latency=0.0,jitter=0.0,failure_rate=0.0,seed=0,sleep=time.sleep):
+		# latency is the seconds for each call, or a dictionary of seconds keyed
+		# by operation ('get', 'put', 'delete' or 'query'), and jitter is the
+		# maximum number of seconds added at random to the latency
+		assert failure_rate >= 0.0 and failure_rate <= 1.0,"LatencyProfile.__init__: Invalid failure_rate"
+		self._latency = latency
+		self._jitter = jitter
+		self._failure_rate = failure_rate
+		self._sleep = sleep
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+
+	# PUBLIC METHODS
+	def get_latency(self,operation):
+		if isinstance(self._latency,dict):
+			return self._latency.get(operation,0.0)
+		return self._latency
+	def call(self,operation):
+		"""Wait for the latency of an operation, or raise DatastoreError at the failure rate"""
+		with self._lock:
+			failed = self._failure_rate and self._random.random() < self._failure_rate
+			delay = self.get_latency(operation) + (self._jitter * self._random.random() if self._jitter else 0.0)
+		if delay > 0.0:
+			self._sleep(delay)
+		if failed:
+			raise DatastoreError("Injected failure for '%s' operation" % operation)
+
+class Storage(object):
+	"""Entities in process memory, as dictionaries of values indexed by kind and
+	key, with a sorted list of the keys of each kind for reading in key order"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._kinds = { }
+		self._keys = { }
+		self._next_key = { }
+
+	# PUBLIC METHODS
+	def get(self,kind,keys):
+		"""Return list of copies of the values for keys, with None for missing entities"""
+		with self._lock:
+			entities = self._kinds.get(kind,{ })
+			return [ dict(entities[key]) if key in entities else None for key in keys ]
+	def put(self,kind,key,values,fields=None):
+		"""Store values, or only the values for fields, and return the key. A new key is allocated when key is None"""
+		with self._lock:
+			entities = self._kinds.setdefault(kind,{ })
+			if key==None:
+				key = self._next_key.get(kind,1)
+				self._next_key[kind] = key + 1
+			if key not in entities:
+				# new keys are allocated in order, so are usually appended
+				bisect.insort(self._keys.setdefault(kind,[ ]),key)
+				entities[key] = dict(values)
+			elif fields==None:
+				entities[key] = dict(values)
+			else:
+				for name in fields:
+					entities[key][name] = values.get(name)
+			return key
+	def delete(self,kind,keys):
+		with self._lock:
+			entities = self._kinds.get(kind,{ })
+			sorted_keys = self._keys.get(kind,[ ])
+			for key in keys:
+				if entities.pop(key,None) != None:
+					del sorted_keys[bisect.bisect_left(sorted_keys,key)]
+	def items(self,kind):
+		"""Return list of (key,values) for all entities of a kind, with copies of the values"""
+		with self._lock:
+			return [ (key,dict(values)) for (key,values) in self._kinds.get(kind,{ }).iteritems() ]
+	def scan(self,kind,after=None,predicate=None,limit=None):
+		"""Return list of (key,values) in key order for keys after a key, where values
+		are copies, stopping after limit entities whose values match the predicate"""
+		with self._lock:
+			entities = self._kinds.get(kind,{ })
+			sorted_keys = self._keys.get(kind,[ ])
+			start = 0 if after==None else bisect.bisect_right(sorted_keys,after)
+			items = [ ]
+			for key in itertools.islice(sorted_keys,start,None):
+				values = entities[key]
+				if predicate==None or predicate(values):
+					items.append((key,dict(values)))
+					if limit and len(items) >= limit:
+						break
+			return items
+	def count(self,kind):
+		with self._lock:
+			return len(self._kinds.get(kind,{ }))
+	def clear(self,kind=None):
+		"""Remove all entities, or all entities of a kind"""
+		with self._lock:
+			if kind==None:
+				self._kinds.clear()
+				self._keys.clear()
+				self._next_key.clear()
+			else:
+				self._kinds.pop(kind,None)
+				self._keys.pop(kind,None)
+				self._next_key.pop(kind,None)
+
+# storage shared by data stores which are not given their own
+default_storage = Storage()
+
+class Select(query.Select):
+	"""Implements specific methods for the query/select for the in-memory data store"""
+
+	# CONSTANTS
+	OPERATORS = {
+		"=": lambda a,b: a == b,
+		"!=": lambda a,b: a != b,
+		"<": lambda a,b: a < b,
+		"<=": lambda a,b: a <= b,
+		">": lambda a,b: a > b,
+		">=": lambda a,b: a >= b,
+		"IN": lambda a,b: a in b
+	}
+
+	def iterate(self,limit=None):
+		datastore = self._model._get_model_proxy_factory()
+		return self._iterate(datastore,self._select_rows(datastore,limit))
+	def iterate_keys(self,limit=None):
+		datastore = self._model._get_model_proxy_factory()
+		return self._iterate_keys(self._select_rows(datastore,limit))
+	def count(self):
+		datastore = self._model._get_model_proxy_factory()
+		datastore.call("query")
+		if not self.get_filters():
+			return datastore.get_storage().count(datastore.get_entity_name())
+		count = 0
+		for (key,values) in datastore.get_storage().items(datastore.get_entity_name()):
+			values[query.Select.KEY_COLUMN] = key
+			if self._matches(values):
+				count += 1
+		return count
+
+	# PRIVATE METHODS
+	def _select_rows(self,datastore,limit):
+		"""Return list of values of the entities for the page, in order"""
+		orders = self.get_orders() + ((query.Select.KEY_COLUMN,False),)
+		# decode the cursor now, so that an invalid cursor is reported before any entities are read
+		cursor = query.decode_cursor(self._cursor) if self._cursor else None
+		if cursor != None and len(cursor) != len(orders):
+			raise ValueError("Invalid cursor")
+		datastore.call("query")
+		if len(orders)==1:
+			# ordered by key, so read the page in key order from the cursor
+			rows = [ ]
+			for (key,values) in datastore.get_storage().scan(datastore.get_entity_name(),cursor[0] if cursor else None,self._matches if self.get_filters() else None,limit):
+				values[query.Select.KEY_COLUMN] = key
+				rows.append(values)
+			return rows
+		rows = [ ]
+		for (key,values) in datastore.get_storage().items(datastore.get_entity_name()):
+			values[query.Select.KEY_COLUMN] = key
+			if self._matches(values):
+				rows.append(values)
+		# sort by each order in turn, least significant first
+		for (name,descending) in reversed(orders):
+			rows.sort(key=lambda values: values.get(name),reverse=descending)
+		if cursor != None:
+			rows = [ values for values in rows if self._is_after(values,orders,cursor) ]
+		if limit:
+			rows = rows[:limit]
+		return rows
+	def _matches(self,values):
+		for (name,operator,value) in self.get_filters():
+			if not Select.OPERATORS[operator](values.get(name),value):
+				return False
+		return True
+	def _is_after(self,values,orders,cursor):
+		"""Return True if values come after the keyset values of a cursor"""
+		for ((name,descending),position) in zip(orders,cursor):
+			value = values.get(name)
+			if value != position:
+				return value < position if descending else value > position
+		return False
+	def _iterate(self,datastore,rows):
+		model_class = datastore.get_model_class()
+		for values in rows:
+			proxy = (model_class)()
+			proxy._key = values.pop(query.Select.KEY_COLUMN)
+			proxy._values = values
+			yield self._model._from_proxy(proxy,self._fields)
+	def _iterate_keys(self,rows):
+		for values in rows:
+			yield models.KeyRef(self._model,values[query.Select.KEY_COLUMN],dict([ (name,values.get(name)) for (name,descending) in self.get_orders() ]))
+
+class DataModel(models.AbstractDataModel):
+	""""Implements an entity in process memory as a model proxy object"""
+
+	# datastore which generated the model class
+	_datastore = None
+
+	def __init__(self):
+		self._key = None
+		self._values = { }
+	def __setitem__(self,name,value):
+		self._values[name] = value
+	def __getitem__(self,name):
+		return self._values.get(name)
+	@classmethod
+	def get_by_primary_key(self,key):
+		assert (isinstance(key,int) or isinstance(key,long)),"DataModel.get_by_primary_key: Invalid key type"
+		assert key > 0,"DataModel.get_by_primary_key: Invalid key value"
+		return self._datastore.get_multi([ key ])[0]
+	def put(self,fields=None):
+		return self._datastore.put_multi([ self ],[ fields ])[0]
+	def delete(self):
+		assert self.is_saved()==True,"DataModel.delete: Calling delete on new object"
+		self._datastore.delete_multi([ self ])
+	def primary_key(self):
+		return self._key
+	def is_saved(self):
+		return self._key != None
+
+class DataStore(models.AbstractDataStore):
+	""""Factory class which generates in-memory model objects, for running and
+	measuring the API without the App Engine SDK. Each call to the data store,
+	including batch calls, waits for the latency of the profile"""
+	def __init__(self,entity_name,storage=None,profile=None):
+		models.AbstractDataStore.__init__(self,entity_name)
+		assert storage==None or isinstance(storage,Storage),"DataStore.__init__: Invalid storage"
+		assert profile==None or isinstance(profile,LatencyProfile),"DataStore.__init__: Invalid profile"
+		self._storage = storage or default_storage
+		self._profile = profile
+		self._model_class = type(entity_name,(DataModel,),{ '_datastore': self })
+	def get_storage(self):
+		return self._storage
+	def get_profile(self):
+		return self._profile
+	def set_profile(self,profile):
+		"""Set latency profile, or None for no injected latency or failures"""
+		assert profile==None or isinstance(profile,LatencyProfile),"DataStore.set_profile: Invalid profile"
+		self._profile = profile
+	def call(self,operation):
+		"""Wait for the injected latency of a data store call"""
+		if self._profile:
+			self._profile.call(operation)
+	def get_model_class(self):
+		return self._model_class
+	def get_select(self,model,**kwargs):
+		return Select(model,**kwargs)
+	def get_multi(self,keys):
+		self.call("get")
+		proxies = [ ]
+		for (key,values) in zip(keys,self._storage.get(self.get_entity_name(),keys)):
+			if values==None:
+				proxies.append(None)
+				continue
+			proxy = (self._model_class)()
+			proxy._key = key
+			proxy._values = values
+			proxies.append(proxy)
+		return proxies
+	def put_multi(self,proxies,fields=None):
+		self.call("put")
+		fields = fields or [ None ] * len(proxies)
+		for (proxy,names) in zip(proxies,fields):
+			proxy._key = self._storage.put(self.get_entity_name(),proxy._key,proxy._values,names)
+		return [ proxy._key for proxy in proxies ]
+	def delete_multi(self,proxies):
+		self.call("delete")
+		self._storage.delete(self.get_entity_name(),[ proxy.primary_key() for proxy in proxies ])
+		for proxy in proxies:
+			proxy._key = None
+	def encode_proxy(self,proxy):
+		return (proxy.primary_key(),dict(proxy._values))
+	def decode_proxy(self,value):
+		proxy = (self._model_class)()
+		proxy._key = value[0]
+		proxy._values = dict(value[1])
+		return proxy
@@ -3,8 +3,13 @@
 
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
+# Python imports
+import time, threading
+
 # appengineapi-kit imports
 import appengineapi_kit.query
+import appengineapi_kit.instrument
+import appengineapi_kit.futures
 
 # ABSTRACTIONS
 
@@ -16,6 +21,40 @@ class AbstractDataStore(object):
 		raise Exception("AbstractDataStore.get_model_class: Calling abstract method")
 	def get_entity_name(self):
 		return self._entity_name
+	def get_multi(self,keys):
+		"""Return list of proxy objects for keys, with None for missing objects"""
+		model_class = self.get_model_class()
+		return [ model_class.get_by_primary_key(key) for key in keys ]
+	def put_multi(self,proxies,fields=None):
+		"""Store list of proxy objects, where fields is a list with the changed
+		property names for each object, or None to store all properties"""
+		fields = fields or [ None ] * len(proxies)
+		return [ proxy.put(fields=names) for (proxy,names) in zip(proxies,fields) ]
+	def delete_multi(self,proxies):
+		"""Delete list of proxy objects"""
+		for proxy in proxies:
+			proxy.delete()
+	def get_worker_pool(self):
+		"""Return worker pool for asynchronous calls, which limits how many are made at once"""
+		return appengineapi_kit.futures.default_pool
+	def get_multi_async(self,keys):
+		"""Return future for get_multi, which by default is called in a worker thread"""
+		return self.get_worker_pool().run_async(self.get_multi,keys)
+	def put_multi_async(self,proxies,fields=None):
+		"""Return future for put_multi, which by default is called in a worker thread"""
+		return self.get_worker_pool().run_async(self.put_multi,proxies,fields)
+	def update_count(self,delta):
+		"""Add delta to the number of stored entities, for data stores which keep a count"""
+		pass
+	def get_count(self):
+		"""Return number of stored entities, or None when the data store does not keep a count"""
+		return None
+	def encode_proxy(self,proxy):
+		"""Return proxy object encoded for storing in an entity cache"""
+		raise Exception("AbstractDataStore.encode_proxy: Calling abstract method")
+	def decode_proxy(self,value):
+		"""Return new proxy object from a value returned by encode_proxy"""
+		raise Exception("AbstractDataStore.decode_proxy: Calling abstract method")
 
 class AbstractDataModel(object):
 	def __setitem__(self,name,value):
@@ -27,32 +66,58 @@ class AbstractDataModel(object):
 		raise Exception("AbstractDataModel.get_by_primary_key: Calling abstract method")
 	def get_select(self,model,**kwargs):
 		raise Exception("AbstractDataModel.get_select: Calling abstract method")
-	def put(self):
+	def put(self,fields=None):
+		"""Store object, where fields is the list of changed property names for
+		an object which is already stored, so backends can write only those"""
 		raise Exception("AbstractDataModel.put: Calling abstract method")
 	def delete(self):
 		raise Exception("AbstractDataModel.delete: Calling abstract method")
 	def primary_key(self):
 		raise Exception("AbstractDataModel.primary_key: Calling abstract method")
+	def is_saved(self):
+		raise Exception("AbstractDataModel.is_saved: Calling abstract method")
 
 # PROPERTIES
 
 class ModelProperty(object):
 	"""Abstract Model Property class"""
 
+	# counter used to keep properties in the order they are declared
+	_creation_counter = 0
+
+	# values of these types are already JSON-compliant
+	JSON_TYPES = (basestring,bool,int,long,float)
+
 	def __init__(self,notnull=None):
 		self._notnull = notnull
+		self._creation_order = ModelProperty._creation_counter
+		ModelProperty._creation_counter += 1
 	
 	# PUBLIC METHODS
+	def compile_validator(self,name):
+		"""Return function which validates a value for the named property, and
+		which leaves out the checks that are not enabled for the property"""
+		if not self._notnull:
+			return lambda value: value
+		def validate(value):
+			if value==None:
+				raise ValueError("ModelProperty.validate: Value cannot be NULL for property '%s'" % name)
+			return value
+		return validate
+	def compile_encoder(self):
+		"""Return function which returns a JSON-compliant value"""
+		json_types = ModelProperty.JSON_TYPES
+		def encode(value):
+			if value==None or isinstance(value,json_types):
+				return value
+			return "%s" % value
+		return encode
 	def validate(self,name,value):
 		""" Return validated version of a value, or raise an error """
-		if value==None and self._notnull:
-			raise ValueError("ModelProperty.validate: Value cannot be NULL for property '%s'" % name)
-		return value
+		return self.compile_validator(name)(value)
 	def as_json(self,value):
 		"""Return JSON-compliant value"""
-		if type(value) in (basestring,bool,int,long):
-			return value
-		return "%s" % value
+		return self.compile_encoder()(value)
 
 class StringProperty(ModelProperty):
 	"""String Model Property class"""
@@ -63,16 +128,31 @@ class StringProperty(ModelProperty):
 		self._maxlength = maxlength
 
 	# PUBLIC METHODS
-	def validate(self,name,value):
-		"""Validate string value against property"""
-		ModelProperty.validate(self,name,value)
-		if value and isinstance(value,basestring) != True:
-			raise ValueError("StringProperty.validate: Not a string for property '%s'" % name)
-		if value and self._minlength != None and len(value) < self._minlength:
-			raise ValueError("StringProperty.validate: MINLENGTH condition fails for property '%s'" % name)
-		if value and self._maxlength != None and len(value) > self._maxlength:
-			raise ValueError("StringProperty.validate: MAXLENGTH condition fails for property '%s'" % name)
-		return value
+	def compile_validator(self,name):
+		"""Return function which validates string values for the named property"""
+		notnull = self._notnull
+		# a minimum length of zero is always met
+		minlength = self._minlength or None
+		maxlength = self._maxlength
+		def validate(value):
+			if not value:
+				if value==None and notnull:
+					raise ValueError("ModelProperty.validate: Value cannot be NULL for property '%s'" % name)
+				return value
+			if not isinstance(value,basestring):
+				raise ValueError("StringProperty.validate: Not a string for property '%s'" % name)
+			return value
+		if minlength==None and maxlength==None:
+			return validate
+		def validate_length(value):
+			value = validate(value)
+			if value:
+				if minlength != None and len(value) < minlength:
+					raise ValueError("StringProperty.validate: MINLENGTH condition fails for property '%s'" % name)
+				if maxlength != None and len(value) > maxlength:
+					raise ValueError("StringProperty.validate: MAXLENGTH condition fails for property '%s'" % name)
+			return value
+		return validate_length
 
 class IntegerProperty(ModelProperty):
 	"""Integer Model Property class"""
@@ -83,35 +163,99 @@ class IntegerProperty(ModelProperty):
 		self._maxvalue = maxvalue
 
 	# PUBLIC METHODS
-	def validate(self,name,value):
-		"""Validate int or long value against property"""
-		ModelProperty.validate(self,name,value)
-		if value and (isinstance(value,int) or isinstance(value,long)) != True:
-			raise ValueError("IntegerProperty.validate: Not an integer for property '%s'" % name)
-		if value and self._minvalue != None and value < self._minvalue:
-			raise ValueError("IntegerProperty.validate: MINVALUE condition fails for property '%s'" % name)
-		if value and self._maxvalue != None and value > self._maxvalue:
-			raise ValueError("IntegerProperty.validate: MAXVALUE condition fails for property '%s'" % name)
-		return value
+	def compile_validator(self,name):
+		"""Return function which validates int or long values for the named property"""
+		notnull = self._notnull
+		minvalue = self._minvalue
+		maxvalue = self._maxvalue
+		def validate(value):
+			if not value:
+				if value==None and notnull:
+					raise ValueError("ModelProperty.validate: Value cannot be NULL for property '%s'" % name)
+				return value
+			if not isinstance(value,(int,long)):
+				raise ValueError("IntegerProperty.validate: Not an integer for property '%s'" % name)
+			return value
+		if minvalue==None and maxvalue==None:
+			return validate
+		def validate_range(value):
+			value = validate(value)
+			if value:
+				if minvalue != None and value < minvalue:
+					raise ValueError("IntegerProperty.validate: MINVALUE condition fails for property '%s'" % name)
+				if maxvalue != None and value > maxvalue:
+					raise ValueError("IntegerProperty.validate: MAXVALUE condition fails for property '%s'" % name)
+			return value
+		return validate_range
+
+# SCHEMA
+
+class ModelSchema(object):
+	"""Properties of a Model class, compiled once when the class is created"""
+	def __init__(self,model_class):
+		properties = [ (name,value) for (name,value) in vars(model_class).iteritems() if isinstance(value,ModelProperty) ]
+		properties.sort(key=lambda item: item[1]._creation_order)
+		# ordered property names, and property objects, compiled validators and
+		# compiled encoders by name
+		self.names = tuple([ name for (name,value) in properties ])
+		self.properties = dict(properties)
+		self.validators = dict([ (name,value.compile_validator(name)) for (name,value) in properties ])
+		self.encoders = dict([ (name,value.compile_encoder()) for (name,value) in properties ])
+		self._record = tuple([ (name,self.validators[name],self.properties[name]._notnull) for name in self.names ])
+
+	# PUBLIC METHODS
+	def validate_record(self,values):
+		"""Return list of (name,value) pairs for every property, validated in one
+		pass over a dictionary of values. Missing values are None, and are only
+		validated for properties which cannot be NULL"""
+		return [ (name,validate(values[name]) if name in values else (validate(None) if notnull else None)) for (name,validate,notnull) in self._record ]
+	def validate_values(self,values):
+		"""Return list of (name,value) pairs for the properties in a dictionary of
+		values, or raise TypeError if there are values for unknown properties"""
+		validators = self.validators
+		invalid_keys = [ name for name in values if name not in validators ]
+		if len(invalid_keys):
+			raise TypeError("Model.update: invalid update data: %s" % ", ".join(invalid_keys))
+		return [ (name,validators[name](value)) for (name,value) in values.iteritems() ]
+
+class ModelType(type):
+	"""Metaclass which compiles the schema for each Model class"""
+	def __init__(cls,name,bases,attrs):
+		super(ModelType,cls).__init__(name,bases,attrs)
+		cls._schema = ModelSchema(cls)
+		cls._write_stats = { 'writes': 0, 'avoided_writes': 0 }
 
 # MODEL
 
+# lock for the write counters of all Model classes
+write_stats_lock = threading.Lock()
+
 class Model(object):
 	"""Abstract Model class"""
+	__metaclass__ = ModelType
+
 	def __init__(self,**kwargs):
-		self.__properties = self._get_properties()
 		self.__proxy_class = self._get_model_proxy_factory().get_model_class()
+		# names of properties returned by a projection query, or None for all properties
+		self.__fields = None
 		if '_proxy' in kwargs:
 			# proxy object already contains values
 			self.__proxy = kwargs['_proxy']
+			# names of properties changed since the object was read
+			self.__dirty = set()
 		else:
 			# set values from arguments
 			self.__proxy = (self.__proxy_class)()
-			for (k,v) in self.__properties.iteritems():
-				if k in kwargs:
-					self[k] = kwargs[k]
-				else:
-					self[k] = None
+			for (name,value) in self._schema.validate_record(kwargs):
+				self.__proxy[name] = value
+			self.__dirty = set(self._schema.names)
+	@classmethod
+	def _from_proxy(self,proxy,fields=None):
+		"""Return object for a proxy read from the data store, where fields are the
+		names of the properties returned by a projection query"""
+		obj = (self)(_proxy=proxy)
+		obj.__fields = fields
+		return obj
 	@classmethod
 	def _get_model_proxy_factory(self):
 		"""Return proxy factory object, which can generate concrete proxy models"""
@@ -119,14 +263,13 @@ class Model(object):
 		assert isinstance(self.proxy,AbstractDataStore),"Model._get_model_proxy_factory: proxy needs to be subclass of AbstractDataStore"
 		return self.proxy
 	@classmethod
+	def _get_entity_cache(self):
+		"""Return entity cache object, or None if the model is not cached"""
+		return getattr(self,'entity_cache',None)
+	@classmethod
 	def _get_properties(self):
 		""" Get all model properties as dictionary """
-		properties = { }
-		for name in vars(self):
-			value = getattr(self,name)
-			if isinstance(value,ModelProperty):
-				properties[name] = value
-		return properties
+		return self._schema.properties
 	@classmethod
 	def get_kind(self):
 		"""Return name used to represent the model"""
@@ -135,14 +278,32 @@ class Model(object):
 	def get_select(self,**kwargs):
 		"""Return select statement used to represent the model"""
 		return self._get_model_proxy_factory().get_select(self,**kwargs)
+	def _get_proxy(self):
+		"""Return proxy object which stores the values, reading it for lazy objects"""
+		if isinstance(self.__proxy,LazyProxy):
+			self.__proxy = self.__proxy.get_proxy()
+		return self.__proxy
 	def key(self):
 		return self.__proxy.primary_key()
 	def is_saved(self):
 		return self.__proxy.is_saved()
+	def _set_value(self,name,value):
+		"""Set validated value, marking the property as changed if the value is different"""
+		if name in self.__dirty or self.__proxy[name] != value:
+			self.__proxy[name] = value
+			self.__dirty.add(name)
+	def _set_clean(self):
+		"""Mark all properties as unchanged, once the object has been stored"""
+		self.__dirty.clear()
+	def is_dirty(self):
+		"""Return True if properties have changed since the object was read or stored"""
+		return len(self.__dirty) > 0
+	def get_dirty_fields(self):
+		"""Return names of properties which have changed, in the order they are declared"""
+		return tuple([ name for name in self._schema.names if name in self.__dirty ])
 	def __setitem__(self,name,value):
 		""" Set value for model object """
-		model_property = self.__properties[name]
-		self.__proxy[name] = model_property.validate(name,value)
+		self._set_value(name,self._schema.validators[name](value))
 	def __getitem__(self,name):
 		""" Get value for model object """
 		return self.__proxy[name]
@@ -153,40 +314,351 @@ class Model(object):
 		}
 		if self.key():
 			response['_key'] = self.key()
-		for (k,p) in self.__properties.iteritems():
-			response[k] = p.as_json(self.__proxy[k])
+		encoders = self._schema.encoders
+		for name in (self.__fields or self._schema.names):
+			response[name] = encoders[name](self.__proxy[name])
 		return response
+	def as_json_items(self):
+		"""Return list of (name,value) pairs with JSON-compliant values, in the
+		order the properties are declared, for codecs which encode them directly"""
+		items = [ ('_type',self.get_kind()) ]
+		if self.key():
+			items.append(('_key',self.key()))
+		encoders = self._schema.encoders
+		for name in (self.__fields or self._schema.names):
+			items.append((name,encoders[name](self.__proxy[name])))
+		return items
 	def put(self):
-		"""Store object in data store"""
-		return self.__proxy.put()
+		"""Store object in data store. Only the changed properties are written by
+		backends which support it, and objects which have not changed since they
+		were read are not written at all, in which case None is returned"""
+		if self.is_saved():
+			if not self.__dirty:
+				self._count_writes(avoided_writes=1)
+				return None
+			with self._store_call("put"):
+				result = self.__proxy.put(fields=self.get_dirty_fields())
+		else:
+			with self._store_call("put"):
+				result = self.__proxy.put()
+			self._get_model_proxy_factory().update_count(1)
+		self._set_clean()
+		self._count_writes(writes=1)
+		self._written([ self.key() ])
+		return result
 	def delete(self):
 		"""Delete object from the data store"""
-		return self.__proxy.delete()
+		key = self.key()
+		with self._store_call("delete"):
+			result = self.__proxy.delete()
+		self._get_model_proxy_factory().update_count(-1)
+		self._invalidate([ key ])
+		return result
+	def put_async(self):
+		"""Start storing the object in a worker thread of the data store, and return
+		a future for the result of put. The cached entity is invalidated, the
+		version changed and the object marked as unchanged when the write starts,
+		and the count of stored objects is updated by the worker once the write
+		has completed, whether or not the result is read. Reads from the data
+		store may return the old values until the write has completed, and the
+		object is marked as changed again if the result is read and the write
+		failed"""
+		if self.is_saved() and not self.__dirty:
+			self._count_writes(avoided_writes=1)
+			return appengineapi_kit.futures.Future.from_result(None)
+		factory = self._get_model_proxy_factory()
+		proxy = self._get_proxy()
+		fields = self.get_dirty_fields() if self.is_saved() else None
+		dirty = set(self.__dirty)
+		self._written([ self.key() ] if fields != None else [ ])
+		self._set_clean()
+		self._count_writes(writes=1)
+		appengineapi_kit.instrument.count_rpc("put")
+		def put():
+			result = factory.put_multi([ proxy ],fields=[ fields ])
+			if fields==None:
+				factory.update_count(1)
+			# invalidate again, in case the old entity was cached during the write
+			self._written([ proxy.primary_key() ])
+			return result[0]
+		future = factory.get_worker_pool().run_async(put)
+		def wait():
+			try:
+				return future.get_result()
+			except Exception:
+				# the changes have not been stored
+				self.__dirty.update(dirty)
+				raise
+		return appengineapi_kit.futures.Future(wait)
+	def set_values(self,values):
+		"""Set property values from a dictionary without storing the object. All
+		values are validated before any are set"""
+		assert isinstance(values,dict),"Model.set_values: Invalid values argument"
+		for (name,value) in self._schema.validate_values(values):
+			self._set_value(name,value)
 	def update(self,values):
 		assert isinstance(values,dict)
-		all_keys = values.keys()
-		# translate values
-		for (name,prop) in self.__properties.iteritems():
-			if name in values:
-				values[name] = prop.validate(name,values[name])
-				all_keys.remove(name)
-		if len(all_keys):
-			raise TypeError("Model.update: invalid update data: %s" % ", ".join(all_keys))
-		# update object with values
-		for (name,prop) in self.__properties.iteritems():
-			if name in values:
-				self.__proxy[name] = values[name]
-		# put the entity back to datastore
+		self.set_values(values)
+		# put the entity back to datastore, if any values have changed
 		self.put()
 	@classmethod
 	def get_by_key(self,key):
-		"""Retrieve object from the data store by key"""
-		proxy = self.proxy.get_model_class().get_by_primary_key(key)
+		"""Retrieve object from the data store by key, reading through the entity cache"""
+		factory = self._get_model_proxy_factory()
+		entity_cache = self._get_entity_cache()
+		if entity_cache:
+			value = entity_cache.get(self.get_kind(),key)
+			if value != None:
+				return (self)(_proxy=factory.decode_proxy(value))
+		with self._store_call("get"):
+			proxy = factory.get_model_class().get_by_primary_key(key)
 		if proxy:
+			if entity_cache:
+				entity_cache.set(self.get_kind(),key,factory.encode_proxy(proxy))
+				if entity_cache.get_version(self.get_kind(),key)==None:
+					entity_cache.set_version(self.get_kind(),key,time.time())
 			return (self)(_proxy=proxy)
 		else:
 			return None
 	@classmethod
+	def get_by_key_async(self,key):
+		"""Start retrieving an object from the data store by key, and return a future
+		for the object or None. Cached objects are returned without a data store call"""
+		factory = self._get_model_proxy_factory()
+		entity_cache = self._get_entity_cache()
+		if entity_cache:
+			value = entity_cache.get(self.get_kind(),key)
+			if value != None:
+				return appengineapi_kit.futures.Future.from_result((self)(_proxy=factory.decode_proxy(value)))
+		appengineapi_kit.instrument.count_rpc("get")
+		future = factory.get_multi_async([ key ])
+		def retrieved(proxies):
+			proxy = proxies[0]
+			if proxy==None:
+				return None
+			if entity_cache:
+				entity_cache.set(self.get_kind(),key,factory.encode_proxy(proxy))
+				if entity_cache.get_version(self.get_kind(),key)==None:
+					entity_cache.set_version(self.get_kind(),key,time.time())
+			return (self)(_proxy=proxy)
+		return future.then(retrieved)
+	@classmethod
+	def get_by_keys(self,keys):
+		"""Retrieve list of objects from the data store by key, with None for missing objects"""
+		assert isinstance(keys,(list,tuple)),"Model.get_by_keys: Invalid keys argument"
+		factory = self._get_model_proxy_factory()
+		entity_cache = self._get_entity_cache()
+		if entity_cache==None:
+			with self._store_call("get_multi"):
+				proxies = factory.get_multi(keys)
+			return [ (self)(_proxy=proxy) if proxy else None for proxy in proxies ]
+		# read cached objects, then the rest from the data store with one batch call
+		kind = self.get_kind()
+		proxies = { }
+		for key in keys:
+			value = entity_cache.get(kind,key)
+			if value != None:
+				proxies[key] = factory.decode_proxy(value)
+		missing = [ key for key in keys if key not in proxies ]
+		if len(missing):
+			with self._store_call("get_multi"):
+				stored = factory.get_multi(missing)
+			for (key,proxy) in zip(missing,stored):
+				if proxy:
+					entity_cache.set(kind,key,factory.encode_proxy(proxy))
+					proxies[key] = proxy
+		return [ (self)(_proxy=proxies[key]) if key in proxies else None for key in keys ]
+	@classmethod
+	def put_multi(self,objects):
+		"""Store list of objects in the data store"""
+		assert isinstance(objects,(list,tuple)),"Model.put_multi: Invalid objects argument"
+		for obj in objects:
+			assert isinstance(obj,self),"Model.put_multi: Invalid object of type %s" % type(obj).__name__
+		# objects which have not changed since they were read are not written
+		changed = [ obj for obj in objects if obj.is_dirty() or not obj.is_saved() ]
+		self._count_writes(writes=len(changed),avoided_writes=len(objects) - len(changed))
+		if len(changed)==0:
+			return [ ]
+		fields = [ obj.get_dirty_fields() if obj.is_saved() else None for obj in changed ]
+		with self._store_call("put_multi"):
+			result = self._get_model_proxy_factory().put_multi([ obj._get_proxy() for obj in changed ],fields=fields)
+		created = fields.count(None)
+		if created:
+			self._get_model_proxy_factory().update_count(created)
+		for obj in changed:
+			obj._set_clean()
+		self._written([ obj.key() for obj in changed ])
+		return result
+	@classmethod
+	def delete_multi(self,objects):
+		"""Delete list of objects from the data store"""
+		assert isinstance(objects,(list,tuple)),"Model.delete_multi: Invalid objects argument"
+		for obj in objects:
+			assert isinstance(obj,self),"Model.delete_multi: Invalid object of type %s" % type(obj).__name__
+		keys = [ obj.key() for obj in objects ]
+		with self._store_call("delete_multi"):
+			result = self._get_model_proxy_factory().delete_multi([ obj._get_proxy() for obj in objects ])
+		self._get_model_proxy_factory().update_count(-len(objects))
+		self._invalidate(keys)
+		return result
+	@classmethod
+	def _invalidate(self,keys):
+		"""Invalidate cached entities for keys, and change the version of the kind"""
+		entity_cache = self._get_entity_cache()
+		if entity_cache:
+			for key in keys:
+				entity_cache.invalidate(self.get_kind(),key)
+			entity_cache.set_kind_version(self.get_kind(),time.time())
+	@classmethod
+	def _written(self,keys):
+		"""Invalidate cached entities for keys which have been stored, and record new
+		versions for them and for the kind"""
+		entity_cache = self._get_entity_cache()
+		if entity_cache:
+			version = time.time()
+			for key in keys:
+				entity_cache.written(self.get_kind(),key,version)
+			entity_cache.set_kind_version(self.get_kind(),version)
+	@classmethod
+	def _store_call(self,name):
+		"""Count a data store call for the request being recorded, and return
+		context manager which records the time spent in the call"""
+		appengineapi_kit.instrument.count_rpc(name)
+		return appengineapi_kit.instrument.timer("datastore")
+	@classmethod
+	def _count_writes(self,writes=0,avoided_writes=0):
+		with write_stats_lock:
+			self._write_stats['writes'] += writes
+			self._write_stats['avoided_writes'] += avoided_writes
+	@classmethod
+	def get_write_stats(self):
+		"""Return dictionary of counters for objects written, and writes avoided
+		because objects had not changed"""
+		with write_stats_lock:
+			return dict(self._write_stats)
+	@classmethod
+	def reset_write_stats(self):
+		with write_stats_lock:
+			for name in self._write_stats:
+				self._write_stats[name] = 0
+	@classmethod
+	def get_version(self,key):
+		"""Return version of the stored object as a timestamp, or None when not known.
+		Versions are recorded in the entity cache when objects are stored or read"""
+		entity_cache = self._get_entity_cache()
+		if entity_cache:
+			return entity_cache.get_version(self.get_kind(),key)
+		return None
+	@classmethod
+	def get_kind_version(self):
+		"""Return version of all objects of the model as a timestamp, which changes
+		when any object is stored or deleted through the model, or None when there
+		is no entity cache. When the version is not known, it is recorded as now"""
+		entity_cache = self._get_entity_cache()
+		if entity_cache==None:
+			return None
+		version = entity_cache.get_kind_version(self.get_kind())
+		if version==None:
+			version = time.time()
+			entity_cache.set_kind_version(self.get_kind(),version)
+		return version
+	@classmethod
 	def get_query(self):
 		"""Return query object"""
 		return appengineapi_kit.query.Query(self)
+
+# KEY REFERENCES
+
+class KeyRef(object):
+	"""Reference to a stored object, returned by keys-only queries without
+	reading the entity. Values of the ordered properties are kept for cursors"""
+	__slots__ = ('_model','_key','_values')
+
+	def __init__(self,model,key,values=None):
+		assert issubclass(model,Model),"KeyRef.__init__: Invalid model"
+		self._model = model
+		self._key = key
+		self._values = values or { }
+
+	# PUBLIC METHODS
+	def key(self):
+		return self._key
+	def get_model(self):
+		return self._model
+	def get_kind(self):
+		return self._model.get_kind()
+	def get(self):
+		"""Return the model object from the data store, or None if it has been deleted"""
+		return self._model.get_by_key(self._key)
+	def __getitem__(self,name):
+		return self._values[name]
+	def __eq__(self,other):
+		return isinstance(other,KeyRef) and self._model==other._model and self._key==other._key
+	def __ne__(self,other):
+		return not self.__eq__(other)
+	def __hash__(self):
+		return hash((self._model,self._key))
+	def __repr__(self):
+		return "<KeyRef %s %s>" % (self.get_kind(),self._key)
+	def as_json(self):
+		return {
+			'_type': self.get_kind(),
+			'_key': self._key
+		}
+	def as_json_items(self):
+		return [ ('_type',self.get_kind()),('_key',self._key) ]
+
+# LAZY OBJECTS
+
+class LazyBatch(object):
+	"""Keys of model objects which are read together from the data store, when
+	the values of any one of them are first accessed"""
+	def __init__(self,model,keys):
+		self._model = model
+		self._keys = keys
+		self._proxies = None
+
+	# PUBLIC METHODS
+	def get_model(self):
+		return self._model
+	def is_loaded(self):
+		return self._proxies != None
+	def get_proxy(self,key):
+		"""Return proxy object for key, or None if the object has been deleted"""
+		if self._proxies==None:
+			# one batch call for the keys, reading through the entity cache
+			objects = self._model.get_by_keys(self._keys)
+			self._proxies = dict([ (obj.key(),obj._get_proxy()) for obj in objects if obj != None ])
+		return self._proxies.get(key)
+
+class LazyProxy(AbstractDataModel):
+	"""Proxy object for a stored object, which is read with the other objects in
+	its batch when values are first accessed. Objects deleted since the query
+	ran have no values, and cannot be stored"""
+	def __init__(self,batch,key):
+		assert isinstance(batch,LazyBatch),"LazyProxy.__init__: Invalid batch"
+		self._batch = batch
+		self._key = key
+
+	# PUBLIC METHODS
+	def get_proxy(self):
+		"""Return proxy object of the data store, reading the batch if necessary"""
+		proxy = self._batch.get_proxy(self._key)
+		if proxy==None:
+			raise LookupError("LazyProxy.get_proxy: No %s entity with key %s" % (self._batch.get_model().get_kind(),self._key))
+		return proxy
+	def __setitem__(self,name,value):
+		self.get_proxy()[name] = value
+	def __getitem__(self,name):
+		proxy = self._batch.get_proxy(self._key)
+		if proxy==None:
+			return None
+		return proxy[name]
+	def put(self,fields=None):
+		return self.get_proxy().put(fields=fields)
+	def delete(self):
+		return self.get_proxy().delete()
+	def primary_key(self):
+		return self._key
+	def is_saved(self):
+		return True
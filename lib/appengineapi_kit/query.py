@@ -4,61 +4,396 @@
 __author__ = "djt@mutablelogic.com (David Thorpe)"
 
 # python imports
-import logging
+import logging, base64, itertools
 
 # local imports
 import appengineapi_kit.api
 import appengineapi_kit.models
+import appengineapi_kit.encoding
+import appengineapi_kit.instrument
+import appengineapi_kit.futures
+
+# CURSORS
+
+def encode_cursor(values):
+	"""Return opaque cursor string for a list of keyset values"""
+	return base64.urlsafe_b64encode(appengineapi_kit.encoding.dumps(values))
+
+def decode_cursor(cursor):
+	"""Return list of keyset values from an opaque cursor string, or raise ValueError"""
+	try:
+		values = appengineapi_kit.encoding.loads(base64.urlsafe_b64decode(str(cursor)))
+	except (TypeError,ValueError,UnicodeEncodeError):
+		raise ValueError("Invalid cursor")
+	if not isinstance(values,list) or len(values)==0:
+		raise ValueError("Invalid cursor")
+	return values
+
+# SELECT
 
 class Select(object):
-	def __init__(self,model):
+
+	# CONSTANTS
+	KEY_COLUMN = "id"
+	OPERATORS = ("=","!=","<","<=",">",">=","IN")
+	MODE_ENTITIES = "entities"
+	MODE_KEYS = "keys"
+	MODE_LAZY = "lazy"
+	LAZY_BATCH_SIZE = 100
+	# NULL sorts before all other values in ascending order, as in MySQL and SQLite
+	NULLS_FIRST = True
+
+	def __init__(self,model,cursor=None,filters=None,orders=None,fields=None,mode=None):
 		assert issubclass(model,appengineapi_kit.models.Model)
+		assert cursor==None or isinstance(cursor,basestring),"Select.__init__: Invalid cursor"
+		assert mode in (None,Select.MODE_ENTITIES,Select.MODE_KEYS,Select.MODE_LAZY),"Select.__init__: Invalid mode"
 		self._model = model
+		self._cursor = cursor
+		self._end_cursor = None
+		# tuple of (name,operator,value) filters and (name,descending) orders
+		self._filters = tuple(filters or ( ))
+		self._orders = tuple(orders or ( ))
+		# tuple of property names to return, or None for all properties
+		self._fields = tuple(fields) if fields else None
+		# results are model objects, key references, or model objects which
+		# are read from the data store when their values are first accessed
+		self._mode = mode or Select.MODE_ENTITIES
 	def bindings(self):
-		return [ ]
-	def as_sql(self):
-		return "SELECT %s FROM %s" % ("*",self._model.get_kind())
-	def run(self,limit=None):
-		return Feed(self._model,limit)
+		return self._compile_sql(None,"%s")[1]
+	def as_sql(self,limit=None,placeholder="%s"):
+		"""Return parameterized SQL statement, using keyset pagination from the cursor"""
+		return self._compile_sql(limit,placeholder)[0]
+	def get_filters(self):
+		return self._filters
+	def get_orders(self):
+		return self._orders
+	def get_mode(self):
+		return self._mode
+	def get_fields(self):
+		"""Return property names to return, including those needed for ordering, or None"""
+		if self._fields==None:
+			return None
+		return self._fields + tuple([ name for (name,descending) in self._orders if name not in self._fields ])
+	def get_cursor(self):
+		"""Return cursor which the select starts from"""
+		return self._cursor
+	def get_end_cursor(self):
+		"""Return cursor for the following page, or None when there are no more results"""
+		return self._end_cursor
+	def end_cursor(self,entity):
+		"""Return cursor for the results after entity, by default the keyset of the ordered values and key"""
+		return encode_cursor([ entity[name] for (name,descending) in self._orders ] + [ entity.key() ])
+	def iterate(self,limit=None):
+		"""Return iterator of model objects, implemented by the data store"""
+		return iter([ ])
+	def iterate_keys(self,limit=None):
+		"""Return iterator of key references, implemented by data stores which can
+		query keys without reading entities. By default the entities are read"""
+		return self._key_refs(self.iterate(limit))
+	def count(self):
+		"""Return number of entities matching the select. By default the entities
+		are read and counted, so data stores should count them without reading them"""
+		count = 0
+		for entity in self.iterate():
+			count += 1
+		return count
+	def run(self,limit=None,stream=False):
+		"""Return feed of model objects. When stream is True, the objects are read lazily"""
+		appengineapi_kit.instrument.count_rpc("query")
+		with appengineapi_kit.instrument.timer("datastore"):
+			source = self._source(limit)
+			if not stream:
+				return self._read_feed(source,limit)
+		# objects are read as the feed is encoded, so reading each is timed
+		return Feed(self._model,limit,source=appengineapi_kit.instrument.timed("datastore",source),select=self)
+	def run_async(self,limit=None):
+		"""Return future for the feed of model objects, which by default is read in a
+		worker thread of the data store"""
+		appengineapi_kit.instrument.count_rpc("query")
+		pool = self._model._get_model_proxy_factory().get_worker_pool()
+		return pool.run_async(lambda: self._read_feed(self._source(limit),limit))
+
+	# PRIVATE METHODS
+	def _source(self,limit):
+		"""Return iterator of results for the mode of the select, which sets the end cursor once read"""
+		if self._mode==Select.MODE_ENTITIES:
+			return self._paginate(self.iterate(limit),limit)
+		source = self._paginate(self.iterate_keys(limit),limit)
+		if self._mode==Select.MODE_LAZY:
+			return self._hydrate(source)
+		return source
+	def _key_refs(self,entities):
+		"""Yield key references for model objects, with the values of ordered properties"""
+		for entity in entities:
+			yield appengineapi_kit.models.KeyRef(self._model,entity.key(),dict([ (name,entity[name]) for (name,descending) in self._orders ]))
+	def _hydrate(self,refs):
+		"""Yield lazy model objects for key references. Each batch of objects is read
+		with one data store call, when the values of any of them are first accessed"""
+		while True:
+			chunk = list(itertools.islice(refs,Select.LAZY_BATCH_SIZE))
+			if len(chunk)==0:
+				break
+			batch = appengineapi_kit.models.LazyBatch(self._model,[ ref.key() for ref in chunk ])
+			for ref in chunk:
+				yield self._model._from_proxy(appengineapi_kit.models.LazyProxy(batch,ref.key()),self._fields)
+	def _compile_conditions(self,placeholder):
+		"""Return tuple of (conditions,bindings) for the filters"""
+		conditions = [ ]
+		bindings = [ ]
+		for (name,operator,value) in self._filters:
+			if operator=="IN":
+				conditions.append("%s IN (%s)" % (name,",".join([ placeholder ] * len(value))))
+				bindings.extend(value)
+			else:
+				conditions.append("%s %s %s" % (name,"<>" if operator=="!=" else operator,placeholder))
+				bindings.append(value)
+		return (conditions,bindings)
+	def _compile_count_sql(self,placeholder):
+		"""Return tuple of (sql,bindings) for counting the entities matching the filters"""
+		(conditions,bindings) = self._compile_conditions(placeholder)
+		sql = "SELECT COUNT(*) FROM %s" % self._model.get_kind()
+		if len(conditions):
+			sql += " WHERE %s" % " AND ".join(conditions)
+		return (sql,bindings)
+	def _compile_after(self,name,descending,value,placeholder):
+		"""Return tuple of (condition,bindings) for the column values which sort after
+		value in the order, or None when there are none"""
+		# NULL is last when it sorts first and the order is descending, or the reverse
+		nulls_last = descending==self.NULLS_FIRST
+		if value==None:
+			if nulls_last:
+				return None
+			return ("%s IS NOT NULL" % name,[ ])
+		condition = "%s %s %s" % (name,"<" if descending else ">",placeholder)
+		if nulls_last:
+			return ("(%s OR %s IS NULL)" % (condition,name),[ value ])
+		return (condition,[ value ])
+	def _compile_sql(self,limit,placeholder,keys_only=False):
+		"""Return tuple of (sql,bindings) for the select, or for selecting keys
+		and the ordered columns when keys_only is True"""
+		(conditions,bindings) = self._compile_conditions(placeholder)
+		# results are always ordered by key last, so that pages are stable
+		orders = self._orders + ((Select.KEY_COLUMN,False),)
+		if self._cursor:
+			values = decode_cursor(self._cursor)
+			if len(values) != len(orders):
+				raise ValueError("Invalid cursor")
+			# (a > ?) OR (a = ? AND key > ?), with IS NULL terms for NULL values
+			alternatives = [ ]
+			for i in xrange(len(orders)):
+				(name,descending) = orders[i]
+				after = self._compile_after(name,descending,values[i],placeholder)
+				if after==None:
+					# no values of the column sort after NULL
+					continue
+				terms = [ ]
+				for ((equal_name,equal_descending),value) in zip(orders[:i],values[:i]):
+					if value==None:
+						terms.append("%s IS NULL" % equal_name)
+					else:
+						terms.append("%s = %s" % (equal_name,placeholder))
+						bindings.append(value)
+				terms.append(after[0])
+				bindings.extend(after[1])
+				alternatives.append("(%s)" % " AND ".join(terms))
+			conditions.append("(%s)" % " OR ".join(alternatives))
+		fields = self.get_fields()
+		if keys_only:
+			columns = ", ".join((Select.KEY_COLUMN,) + tuple([ name for (name,descending) in self._orders ]))
+		elif fields==None:
+			columns = "*"
+		else:
+			columns = ", ".join((Select.KEY_COLUMN,) + fields)
+		sql = "SELECT %s FROM %s" % (columns,self._model.get_kind())
+		if len(conditions):
+			sql += " WHERE %s" % " AND ".join(conditions)
+		sql += " ORDER BY %s" % ", ".join([ (name + " DESC") if descending else name for (name,descending) in orders ])
+		if limit:
+			sql += " LIMIT %d" % limit
+		return (sql,bindings)
+	def _read_feed(self,source,limit):
+		"""Return feed with all the model objects from source"""
+		feed = Feed(self._model,limit,select=self)
+		for entity in source:
+			feed.append(entity)
+		return feed
+	def _paginate(self,entities,limit):
+		"""Yield entities, setting the end cursor once they have all been read"""
+		self._end_cursor = None
+		count = 0
+		entity = None
+		for entity in entities:
+			count += 1
+			yield entity
+		# a full page means there may be more results
+		if limit != None and count==limit:
+			self._end_cursor = self.end_cursor(entity)
+
+# FEED
 
 class Feed(object):
-	def __init__(self,model,limit=None):
+	def __init__(self,model,limit=None,source=None,select=None,total=None):
 		assert issubclass(model,appengineapi_kit.models.Model)
 		assert limit==None or (isinstance(limit,(int,long)) and limit > 0)
 		self._model = model
 		self._limit = limit
 		self._items = [ ]
+		# iterator of model objects for streaming feeds, which is consumed once
+		self._source = source
+		# select which generated the feed, used for the cursor
+		self._select = select
+		# number of entities matching the query, or None when not counted
+		self._total = total
 
 	# PROPERTIES
 	def get_items(self):
+		if self._source != None:
+			for item in self._consume():
+				self._items.append(item)
 		return self._items
 	def set_items(self,value):
 		assert isinstance(value,(list,tuple)),"items cannot be of type %s" % type(value).__name__
 		items = [ ]
 		for item in value:
-			assert isinstance(value,self._model)
+			assert isinstance(item,(self._model,appengineapi_kit.models.KeyRef))
 			items.append(item)
 		self._items = items
+		self._source = None
 	items = property(get_items,set_items)
-	
+	def get_cursor(self):
+		"""Return cursor for the following page, once all items have been read"""
+		if self._select==None or self._source != None:
+			return None
+		return self._select.get_end_cursor()
+	cursor = property(get_cursor)
+	def get_total(self):
+		"""Return number of entities matching the query, or None when not counted"""
+		return self._total
+	def set_total(self,value):
+		assert value==None or isinstance(value,(int,long)),"total cannot be of type %s" % type(value).__name__
+		self._total = value
+	total = property(get_total,set_total)
+
+	# PRIVATE METHODS
+	def _consume(self):
+		"""Return the iterator of model objects for a streaming feed, which can only be read once"""
+		source = self._source
+		self._source = None
+		return source
+
 	# METHODS
+	def get_model(self):
+		return self._model
+	def get_limit(self):
+		return self._limit
+	def is_streaming(self):
+		"""Return True if the items have not yet been read from the data store"""
+		return self._source != None
+	def __iter__(self):
+		if self._source != None:
+			return self._consume()
+		return iter(self._items)
 	def append(self,value):
-		assert isinstance(value,self._model)
+		assert isinstance(value,(self._model,appengineapi_kit.models.KeyRef))
 		self._items.append(value)
+	def iter_json(self,encode,chunk_size=100):
+		"""Return generator of JSON strings for the feed, encoding items in chunks as they are read"""
+		yield '{"_type":%s,"limit":%s,"items":[' % (encode(self._model.get_kind()),encode(self._limit))
+		count = 0
+		chunk = [ ]
+		for item in self:
+			chunk.append(encode(item.as_json()))
+			if len(chunk) >= chunk_size:
+				yield ("," if count else "") + ",".join(chunk)
+				count += len(chunk)
+				chunk = [ ]
+		if len(chunk):
+			yield ("," if count else "") + ",".join(chunk)
+			count += len(chunk)
+		if self._total==None:
+			yield '],"count":%s,"cursor":%s}' % (encode(count),encode(self.cursor))
+		else:
+			yield '],"count":%s,"cursor":%s,"total":%s}' % (encode(count),encode(self.cursor),encode(self._total))
+	def iter_encoded(self,codec):
+		"""Return generator of strings for the feed, encoded with a codec from the encoding module"""
+		return codec.iter_feed(self)
 	def as_json(self):
 		"""Return feed object as JSON with JSON-compliant values"""
+		items = [ item.as_json() for item in self.items ]
 		response = {
 			'_type': self._model.get_kind(),
 			'limit': self._limit,
-			'items': [ item.as_json() for item in self.items ],
-			'count': len(self.items)
+			'items': items,
+			'count': len(items),
+			'cursor': self.cursor
 		}
+		if self._total != None:
+			response['total'] = self._total
 		return response
 
 class Query(object):
 	def __init__(self,model):
 		assert issubclass(model,appengineapi_kit.models.Model)
 		self._model = model
-	def execute(self,limit=None):
+		self._filters = [ ]
+		self._orders = [ ]
+		self._fields = None
+		self._mode = None
+
+	# PRIVATE METHODS
+	def _check_property(self,name):
+		if name not in self._model._get_properties():
+			raise ValueError("Query: Invalid property '%s' for '%s'" % (name,self._model.get_kind()))
+
+	# PUBLIC METHODS
+	def filter(self,name,operator,value):
+		"""Add filter on a property, where operator is one of =, !=, <, <=, >, >= or IN"""
+		self._check_property(name)
+		if operator not in Select.OPERATORS:
+			raise ValueError("Query.filter: Invalid operator '%s'" % operator)
+		if operator=="IN":
+			if not isinstance(value,(list,tuple)) or len(value)==0:
+				raise ValueError("Query.filter: IN requires a list of values for '%s'" % name)
+			value = tuple(value)
+		self._filters.append((name,operator,value))
+		return self
+	def order(self,name,descending=False):
+		"""Add sort order on a property"""
+		self._check_property(name)
+		self._orders.append((name,descending))
+		return self
+	def fields(self,*names):
+		"""Return only the named properties in results"""
+		for name in names:
+			self._check_property(name)
+		self._fields = names or None
+		return self
+	def keys_only(self):
+		"""Return key references in results, without reading the entities"""
+		self._mode = Select.MODE_KEYS
+		return self
+	def lazy(self):
+		"""Return model objects in results which are read from the data store when
+		their values are first accessed, in batches across the feed"""
+		self._mode = Select.MODE_LAZY
+		return self
+	def execute(self,limit=None,stream=False,cursor=None,total=False):
+		"""Return feed of results, starting from cursor returned with a previous feed.
+		When total is True, the feed includes the number of matching entities"""
+		assert limit==None or (isinstance(limit,(int,long)) and limit > 0)
+		select = self._model.get_select(cursor=cursor,filters=self._filters,orders=self._orders,fields=self._fields,mode=self._mode)
+		feed = select.run(limit=limit,stream=stream)
+		if total:
+			feed.total = self.count()
+		return feed
+	def count(self):
+		"""Return number of entities matching the filters"""
+		select = self._model.get_select(filters=self._filters)
+		appengineapi_kit.instrument.count_rpc("count")
+		with appengineapi_kit.instrument.timer("datastore"):
+			return select.count()
+	def execute_async(self,limit=None,cursor=None):
+		"""Start the query, and return a future for the feed of results"""
 		assert limit==None or (isinstance(limit,(int,long)) and limit > 0)
-		return self._model.get_select().run(limit=limit)
+		select = self._model.get_select(cursor=cursor,filters=self._filters,orders=self._orders,fields=self._fields,mode=self._mode)
+		return select.run_async(limit=limit)
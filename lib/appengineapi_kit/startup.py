@@ -0,0 +1,100 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import time, logging, threading, contextlib
+
+# GAE imports
+import webapp2
+
+# time the instance started loading the application, and seconds from then
+# until the application was loaded, warmed up and served its first request
+_started = time.time()
+_timings = { }
+_lock = threading.Lock()
+_warm = False
+
+# TIMINGS
+
+def loaded(started=None):
+	"""Record the time taken to load the application, from started (a timestamp
+	taken when loading began) or else the time this module was imported"""
+	global _started
+	if started != None:
+		_started = started
+	elapsed = _mark("import")
+	logging.info("startup: application loaded in %.1f ms" % (elapsed * 1000.0))
+
+def is_warm():
+	"""Return True once the instance has served its first request"""
+	return _warm
+
+@contextlib.contextmanager
+def first_request(method,path):
+	"""Context manager which records the time taken by the first request of the
+	instance, and the time from when the instance started until it completed"""
+	global _warm
+	start = time.time()
+	try:
+		yield
+	finally:
+		with _lock:
+			first = not _warm
+			_warm = True
+			if first:
+				_timings['first_request_duration'] = time.time() - start
+		if first:
+			elapsed = _mark("first_request")
+			logging.info("startup: first request %s %s took %.1f ms, %.1f ms after the instance started" % (method,path,_timings['first_request_duration'] * 1000.0,elapsed * 1000.0))
+
+def get_timings():
+	"""Return dictionary of seconds since the instance started for each startup
+	phase which has completed, and the duration of the first request"""
+	with _lock:
+		return dict(_timings)
+
+# WARMUP
+
+def warmup(app):
+	"""Import the handler of each route, compile the route patterns and prepare
+	the handler classes, so that requests do not pay for this. Return the list
+	of handler classes, or raise an error if a handler is not valid"""
+	router = app.router
+	handlers = [ ]
+	for route in router.match_routes:
+		route.regex
+		handler = route.handler
+		if isinstance(handler,basestring):
+			# import the handler in the same way as the webapp2 dispatcher
+			if handler not in router.handlers:
+				router.handlers[handler] = webapp2.import_string(handler)
+			handler = router.handlers[handler]
+		if route.handler_adapter==None:
+			route.handler_adapter = router.adapt(handler)
+		if handler not in handlers:
+			if hasattr(handler,'prepare_handler'):
+				handler.prepare_handler()
+			handlers.append(handler)
+	elapsed = _mark("warmup")
+	logging.info("startup: warmed up %d routes in %.1f ms after the instance started" % (len(router.match_routes),elapsed * 1000.0))
+	return handlers
+
+class WarmupHandler(webapp2.RequestHandler):
+	"""Handler for /_ah/warmup requests, which App Engine makes to new instances
+	before they serve traffic when warmup is an inbound service in app.yaml"""
+	def get(self):
+		warmup(self.app)
+		self.response.headers['Content-Type'] = "text/plain"
+		timings = get_timings()
+		self.response.write("".join([ "%s=%.1f\n" % (name,timings[name] * 1000.0) for name in sorted(timings) ]))
+
+# PRIVATE METHODS
+
+def _mark(phase):
+	"""Record and return seconds since the instance started for a phase, the first time it completes"""
+	with _lock:
+		if phase not in _timings:
+			_timings[phase] = time.time() - _started
+		return _timings[phase]
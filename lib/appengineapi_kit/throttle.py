@@ -0,0 +1,97 @@
+#!/opt/local/bin/python2.7
+# encoding: utf-8
+
+__author__ = "djt@mutablelogic.com (David Thorpe)"
+
+# Python imports
+import sys, threading, time, collections
+
+class TokenBucket(object):
+	"""Tokens which refill at rate per second, up to burst tokens. Each request
+	takes one token, and is rejected when there are none left"""
+	__slots__ = ('rate','burst','tokens','updated')
+
+	def __init__(self,rate,burst,now):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = now
+
+	# PUBLIC METHODS
+	def take(self,now):
+		"""Return seconds until a token is available, or zero if one has been taken"""
+		self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens >= 1.0:
+			self.tokens -= 1.0
+			return 0.0
+		return (1.0 - self.tokens) / self.rate
+
+class RateLimiter(object):
+	"""Token bucket for each client of an instance, keyed for example by API key
+	or address. Buckets of the least recently seen clients are discarded once
+	there are more than max_clients, so the memory used is bounded"""
+	def __init__(self,rate,burst=None,max_clients=10000,clock=time.time):
+		assert rate > 0,"RateLimiter.__init__: Invalid rate"
+		assert burst==None or burst >= 1,"RateLimiter.__init__: Invalid burst"
+		assert max_clients > 0,"RateLimiter.__init__: Invalid max_clients"
+		self._rate = float(rate)
+		self._burst = burst or max(1,int(rate))
+		self._max_clients = max_clients
+		self._clock = clock
+		self._lock = threading.Lock()
+		# buckets by client key, least recently seen first
+		self._buckets = collections.OrderedDict()
+
+	# PUBLIC METHODS
+	def acquire(self,key):
+		"""Return seconds the client needs to wait before making the request, or
+		zero when the request is allowed"""
+		now = self._clock()
+		with self._lock:
+			bucket = self._buckets.pop(key,None)
+			if bucket==None:
+				bucket = TokenBucket(self._rate,self._burst,now)
+				if len(self._buckets) >= self._max_clients:
+					self._buckets.popitem(last=False)
+			self._buckets[key] = bucket
+			return bucket.take(now)
+	def reset(self):
+		with self._lock:
+			self._buckets.clear()
+
+class SingleFlight(object):
+	"""Calls which are coalesced by key, so that a call made while another with
+	the same key is in progress waits for it and shares its result"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._calls = { }
+
+	# PUBLIC METHODS
+	def do(self,key,func):
+		"""Return tuple of (result,shared) for calling func, where shared is True if
+		the result came from a call already in progress. Exceptions are shared too"""
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call==None
+			if leader:
+				call = self._calls[key] = { 'done': threading.Event() }
+		if not leader:
+			call['done'].wait()
+		else:
+			try:
+				call['result'] = func()
+			except:
+				call['exc_info'] = sys.exc_info()
+			finally:
+				with self._lock:
+					del self._calls[key]
+				call['done'].set()
+		if 'exc_info' in call:
+			exc_info = call['exc_info']
+			raise exc_info[0],exc_info[1],exc_info[2]
+		return (call['result'],not leader)
+	def in_flight(self):
+		"""Return number of calls in progress"""
+		with self._lock:
+			return len(self._calls)